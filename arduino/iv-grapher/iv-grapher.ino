@@ -11,6 +11,16 @@ const int ADCPIN = 44;
 const int VSCALE = 40;
 const int ISCALE = 41;
 
+// Answer to 'I': name, firmware version and the protocol features it has,
+// so the host can tell an IV-grapher from anything else on a serial port
+const char IDENTITY[] = "IV-grapher;1.4;binary,period,oversampling,program,applied";
+
+const uint32_t BAUD = 14400;
+// Longest text line and the binary frame, in bytes. A sample period (times
+// oversampling) shorter than the link needs for one is refused.
+const uint32_t TEXT_BYTES = 30;
+const uint32_t FRAME_BYTES = 12;
+
 const uint8_t dacconf = 0b01110000;
 const uint8_t adcconf1 = 0b00001100;
 const uint8_t adcconf2 = 0b00001101;
@@ -21,45 +31,320 @@ int count = 0;
 boolean highVoltage = true;
 boolean highCurrent = false;
 
-void inline readADC() {
-    uint16_t recv;
+// Sent in binary frames instead of text lines after a 'B' command, 'A' switches back
+boolean binaryMode = false;
+uint8_t sequence = 0;
+
+// Counts the commands that set the output (S, +, -, c, C) once they are
+// applied, wrapping at 256. Every sample carries it, so the host can tell
+// which of its setpoints a sample was taken with.
+uint8_t applied = 0;
+
+// Samples taken by the timer interrupt wait here until loop() sends them, so
+// the interrupt never waits for the serial port. When the link falls behind
+// new samples are dropped, and their sequence numbers are skipped.
+struct Sample {
+    uint16_t data;
+    uint16_t drop;
+    uint16_t current;
+    uint16_t stepIndex;
+    uint8_t highVoltage;
+    uint8_t highCurrent;
+    uint8_t applied;
+    uint8_t sequence;
+};
+const uint8_t FIFO_SIZE = 16;
+volatile Sample fifo[FIFO_SIZE];
+volatile uint8_t fifoHead = 0;
+volatile uint8_t fifoCount = 0;
+
+// Timer1 runs at 4us per tick. Every period one conversion per channel is
+// taken, and every `oversampling` conversions their mean is sent.
+uint32_t period = 32768;
+uint8_t oversampling = 1;
+uint8_t conversions = 0;
+uint32_t dropSum = 0;
+uint32_t currentSum = 0;
+
+// Sweep program uploaded with 'W', stepped from the sample timer. Values are
+// in 0.1uA like on the host: above sweepSwitch the DAC gets value/100 in high
+// current mode and steps are 100 times larger. Every sample sent while
+// sweeping is tagged with the step index, NO_STEP otherwise.
+const uint16_t NO_STEP = 0xFFFF;
+boolean sweeping = false;
+uint32_t sweepValue = 0;
+uint32_t sweepEnd = 0;
+uint32_t sweepStep = 0;
+uint32_t sweepSwitch = 4096;
+uint32_t sweepDwell = 1;
+uint32_t dwellCount = 0;
+uint16_t stepIndex = NO_STEP;
+
+void sendText(const Sample &sample) {
     /* Output format:
-       set current;voltage drop;actual current;high/low voltage;high/low current
+       set current;voltage drop;actual current;high/low voltage;high/low current;applied[;sweep step]
        Currents and voltage is 0-4095
        high/low indicators are 0 or 1
+       applied is the applied setpoint counter, 0-255
+       sweep step is only there while a sweep program runs
     */
-    digitalWrite(ADCPIN, LOW);
-    SPI.transfer(adcconf1);
-    recv = SPI.transfer16(0x0000);
-    digitalWrite(ADCPIN, HIGH);
-    Serial.print(data);
+    Serial.print(sample.data);
     Serial.print(";");
-    Serial.print(recv&0x1FFF, DEC);
-    digitalWrite(ADCPIN, LOW);
-    SPI.transfer(adcconf2);
-    recv = SPI.transfer16(0x0000);
-    digitalWrite(ADCPIN, HIGH);
+    Serial.print(sample.drop, DEC);
+    Serial.print(";");
+    Serial.print(sample.current, DEC);
     Serial.print(";");
-    Serial.print(recv&0x1FFF, DEC);
+    Serial.print(sample.highVoltage, DEC);
     Serial.print(";");
-    Serial.print(highVoltage, DEC);
+    Serial.print(sample.highCurrent, DEC);
     Serial.print(";");
-    Serial.print(highCurrent, DEC);
+    Serial.print(sample.applied, DEC);
+    if (sample.stepIndex != NO_STEP) {
+        Serial.print(";");
+        Serial.print(sample.stepIndex, DEC);
+    }
     // Newline at the end
     Serial.println("");
 }
 
+void sendBinary(const Sample &sample) {
+    /* Frame format, 12 bytes:
+       0-1  sync word 0xA5 0x5A
+       2    sequence counter, wraps at 256
+       3-7  40 bits little endian: bits 0-11 set current, 12-24 voltage drop,
+            25-37 actual current, 38 high voltage, 39 high current
+       8-9  sweep step, little endian, NO_STEP outside sweep programs
+       10   applied setpoint counter
+       11   sum of bytes 2-10, modulo 256
+    */
+    uint8_t frame[12];
+    uint32_t low = (uint32_t)(sample.data & 0x0FFF)
+                 | ((uint32_t)sample.drop << 12)
+                 | ((uint32_t)(sample.current & 0x7F) << 25);
+    frame[0] = 0xA5;
+    frame[1] = 0x5A;
+    frame[2] = sample.sequence;
+    frame[3] = low;
+    frame[4] = low >> 8;
+    frame[5] = low >> 16;
+    frame[6] = low >> 24;
+    frame[7] = (sample.current >> 7) | (sample.highVoltage << 6) | (sample.highCurrent << 7);
+    frame[8] = sample.stepIndex;
+    frame[9] = sample.stepIndex >> 8;
+    frame[10] = sample.applied;
+    uint8_t checksum = 0;
+    for (int i = 2; i < 11; i++) {
+        checksum += frame[i];
+    }
+    frame[11] = checksum;
+    Serial.write(frame, 12);
+}
+
+void inline writeDAC(uint16_t value) {
+    digitalWrite(DACPIN, LOW);
+    SPI.transfer((dacconf & 0xF0) | (0x0F & (value >> 8)));
+    SPI.transfer(value & 0x00FF);
+    digitalWrite(DACPIN, HIGH);
+}
+
+void inline applySweepValue() {
+    if (sweepValue > sweepSwitch) {
+        data = sweepValue / 100;
+        digitalWrite(ISCALE, HIGH);
+        highCurrent = true;
+    } else {
+        data = sweepValue;
+        digitalWrite(ISCALE, LOW);
+        highCurrent = false;
+    }
+    writeDAC(data);
+    // Start the next sample fresh so it only covers the new value
+    conversions = 0;
+    dropSum = 0;
+    currentSum = 0;
+}
+
+void inline advanceSweep() {
+    dwellCount++;
+    if (dwellCount < sweepDwell) {
+        return;
+    }
+    dwellCount = 0;
+    if (sweepValue > sweepSwitch) {
+        sweepValue += sweepStep * 100;
+    } else {
+        sweepValue += sweepStep;
+    }
+    if (sweepValue > sweepEnd) {
+        // Done, leave the output at the end value
+        sweepValue = sweepEnd;
+        sweeping = false;
+        stepIndex = NO_STEP;
+    } else {
+        stepIndex++;
+    }
+    applySweepValue();
+}
+
+void inline queueSample(uint16_t drop, uint16_t current) {
+    // Called from the timer interrupt
+    uint8_t number = sequence++;
+    if (fifoCount == FIFO_SIZE) {
+        return;
+    }
+    volatile Sample &sample = fifo[(fifoHead + fifoCount) % FIFO_SIZE];
+    sample.data = data;
+    sample.drop = drop;
+    sample.current = current;
+    sample.stepIndex = stepIndex;
+    sample.highVoltage = highVoltage;
+    sample.highCurrent = highCurrent;
+    sample.applied = applied;
+    sample.sequence = number;
+    fifoCount++;
+}
+
+void sendSamples() {
+    // Sends queued samples while the transmit buffer has room for them, so
+    // loop() never blocks on the port and keeps taking commands
+    while (true) {
+        uint32_t size = binaryMode ? FRAME_BYTES : TEXT_BYTES;
+        if (fifoCount == 0 || (uint32_t)Serial.availableForWrite() < size) {
+            return;
+        }
+        Sample sample;
+        noInterrupts();
+        sample.data = fifo[fifoHead].data;
+        sample.drop = fifo[fifoHead].drop;
+        sample.current = fifo[fifoHead].current;
+        sample.stepIndex = fifo[fifoHead].stepIndex;
+        sample.highVoltage = fifo[fifoHead].highVoltage;
+        sample.highCurrent = fifo[fifoHead].highCurrent;
+        sample.applied = fifo[fifoHead].applied;
+        sample.sequence = fifo[fifoHead].sequence;
+        fifoHead = (fifoHead + 1) % FIFO_SIZE;
+        fifoCount--;
+        interrupts();
+        if (binaryMode) {
+            sendBinary(sample);
+        } else {
+            sendText(sample);
+        }
+    }
+}
+
+uint32_t minimumInterval() {
+    // Microseconds the link needs per sample, at 10 bits per byte
+    return (binaryMode ? FRAME_BYTES : TEXT_BYTES) * 10 * 1000000 / BAUD;
+}
+
+void inline readADC() {
+    uint16_t drop;
+    uint16_t current;
+    digitalWrite(ADCPIN, LOW);
+    SPI.transfer(adcconf1);
+    dropSum += SPI.transfer16(0x0000) & 0x1FFF;
+    digitalWrite(ADCPIN, HIGH);
+    digitalWrite(ADCPIN, LOW);
+    SPI.transfer(adcconf2);
+    currentSum += SPI.transfer16(0x0000) & 0x1FFF;
+    digitalWrite(ADCPIN, HIGH);
+    conversions++;
+    if (conversions < oversampling) {
+        return;
+    }
+    // Rounded mean of the accumulated conversions
+    drop = (dropSum + conversions / 2) / conversions;
+    current = (currentSum + conversions / 2) / conversions;
+    conversions = 0;
+    dropSum = 0;
+    currentSum = 0;
+    queueSample(drop, current);
+    if (sweeping) {
+        advanceSweep();
+    }
+}
+
 void setDAC(uint16_t value) {
       noInterrupts();
-      digitalWrite(DACPIN, LOW);
-      SPI.transfer((dacconf & 0xF0) | (0x0F & (value >> 8)));
-      SPI.transfer(value & 0x00FF);
-      digitalWrite(DACPIN, HIGH);
+      writeDAC(value);
       interrupts();
 }
 
+void acknowledge() {
+    // After the output has changed, so no sample with the new count is
+    // taken at the old setting
+    noInterrupts();
+    applied++;
+    conversions = 0;
+    dropSum = 0;
+    currentSum = 0;
+    interrupts();
+}
+
+void identify() {
+    // Samples are only sent from loop() too, so nothing lands inside the line
+    Serial.println(IDENTITY);
+}
+
+void setPeriod(uint32_t microseconds) {
+    noInterrupts();
+    OCR1A = microseconds / 4 - 1;
+    if (TCNT1 > OCR1A) {
+        TCNT1 = 0;
+    }
+    interrupts();
+}
+
+void setOversampling(uint8_t count) {
+    noInterrupts();
+    oversampling = count;
+    conversions = 0;
+    dropSum = 0;
+    currentSum = 0;
+    interrupts();
+}
+
+void startSweep(uint32_t start, uint32_t end, uint32_t step, uint32_t dwell, uint32_t rangeSwitch) {
+    noInterrupts();
+    sweepValue = start;
+    sweepEnd = end;
+    sweepStep = step;
+    sweepDwell = dwell;
+    sweepSwitch = rangeSwitch;
+    dwellCount = 0;
+    stepIndex = 0;
+    sweeping = true;
+    applySweepValue();
+    interrupts();
+}
+
+void stopSweep() {
+    noInterrupts();
+    sweeping = false;
+    stepIndex = NO_STEP;
+    interrupts();
+}
+
+uint32_t readNumber(uint32_t fallback, char terminator) {
+    // Reads decimal digits up to the terminator, anything else gives the fallback
+    uint32_t value = 0;
+    while (true) {
+        while (!Serial.available());
+        int in = Serial.read();
+        if (in == terminator) {
+            return value;
+        } else if (in >= '0' && in <= '9') {
+            value = value * 10;
+            value += (in - '0');
+        } else {
+            return fallback;
+        }
+    }
+}
+
 void setup() {
-  Serial.begin(14400);
+  Serial.begin(BAUD);
   Serial.println("Setup");
   SPI.setClockDivider(SPI_CLOCK_DIV32);
   SPI.begin();
@@ -78,23 +363,25 @@ void setup() {
   SPI.transfer(data & 0x00FF);
   digitalWrite(DACPIN, HIGH);
 
+  // CTC mode, prescaler 64
   noInterrupts();
   TCCR1A = 0;
   TCCR1B = 0;
   TCNT1 = 0;
-  TCCR1B |= (1 << CS11);
-  TIMSK1 |= (1 << TOIE1);
+  OCR1A = period / 4 - 1;
+  TCCR1B |= (1 << WGM12) | (1 << CS11) | (1 << CS10);
+  TIMSK1 |= (1 << OCIE1A);
   interrupts();
   
   Serial.println("Setup done");
 }
 
-ISR(TIMER1_OVF_vect) {
-  TCNT1 = 0;
+ISR(TIMER1_COMPA_vect) {
   readADC();
 }
 
 void loop() {
+  sendSamples();
   int in = Serial.read();
   if (in != -1) {
     if (in == '+') {
@@ -119,29 +406,59 @@ void loop() {
       digitalWrite(ISCALE, HIGH);
       highCurrent = true;
     }
+    if (in == 'B') {
+      binaryMode = true;
+    }
+    if (in == 'A' && period * oversampling >= TEXT_BYTES * 10 * 1000000 / BAUD) {
+      // Text lines are longer, only if the sampling period leaves time for them
+      binaryMode = false;
+    }
     if (in == 's' || in == 'S') {
       // Read set value
-      boolean done = false;
-      uint16_t inputdata = 0;
-      while (!done) {
-        while (!Serial.available());
-        in = Serial.read();
-        if (in == '\n') {
-          done = true;
-        } else if (in >= '0' && in <= '9') {
-          inputdata = inputdata * 10;
-          inputdata += (in - '0');
-        } else {
-          inputdata = data;
-          done = true;
-        }
-      }
+      uint32_t inputdata = readNumber(data, '\n');
       if (inputdata < 4096) {
         // Valid input data
         data = inputdata; 
       }
     }
+    if (in == 'p' || in == 'P') {
+      // Sampling period in microseconds, 200us to 262ms, and no faster than
+      // the link can carry the samples
+      uint32_t inputperiod = readNumber(period, '\n');
+      if (inputperiod >= 200 && inputperiod <= 262144 && inputperiod * oversampling >= minimumInterval()) {
+        period = inputperiod;
+        setPeriod(period);
+      }
+    }
+    if (in == 'n' || in == 'N') {
+      // Conversions averaged per sample sent, 1 to 64, with the same limit
+      uint32_t inputcount = readNumber(oversampling, '\n');
+      if (inputcount >= 1 && inputcount <= 64 && period * inputcount >= minimumInterval()) {
+        setOversampling(inputcount);
+      }
+    }
+    if (in == 'W') {
+      // Sweep program: W<start>;<end>;<step>;<samples per step>;<range switch>
+      const uint32_t invalid = 0xFFFFFFFF;
+      uint32_t start = readNumber(invalid, ';');
+      uint32_t end = (start == invalid) ? invalid : readNumber(invalid, ';');
+      uint32_t step = (end == invalid) ? invalid : readNumber(invalid, ';');
+      uint32_t dwell = (step == invalid) ? invalid : readNumber(invalid, ';');
+      uint32_t rangeSwitch = (dwell == invalid) ? invalid : readNumber(invalid, '\n');
+      if (rangeSwitch != invalid && step > 0 && dwell > 0) {
+        startSweep(start, end, step, dwell, rangeSwitch);
+      }
+    }
+    if (in == 'w') {
+      stopSweep();
+    }
+    if (in == 'I') {
+      identify();
+    }
     setDAC(data);
+    if (in == 's' || in == 'S' || in == '+' || in == '-' || in == 'c' || in == 'C') {
+      acknowledge();
+    }
   }
 }
 
@@ -2,12 +2,23 @@ from PyQt5 import QtGui, QtWidgets, QtCore
 from PyQt5.QtCore import QTimer, QSize
 import pyqtgraph as pg
 import sys, random
+import os
+import re
+import time
 import numpy
-import serial
-import threading
+import sqlite3
+from ivcore import defaultSamplePeriod, defaultCalibration, Calibration, candidatePorts, checkSampling
+from ivcapture import CaptureWriter, CaptureReplay
+from ivengine import sweepFixed, sweepModeNames
+from ivdevices import DeviceManager
+from ivfit import fitCurve, modelVoltage, describeFit
+from ivlibrary import SweepLibrary
+from ivmetrics import Metrics, MetricsLog, describeReport
+
+samplesToStore = 100_000
+# Number of newest samples the live plots show until the user zooms or pans
+samplesShown = 256
 
-samplesToStore = 256
-staticCalAddition = 0
 
 class VBar(QtWidgets.QFrame):
     def __init__(self):
@@ -23,16 +34,235 @@ class HBar(QtWidgets.QFrame):
         self.setFrameShadow(QtWidgets.QFrame.Sunken)
 
 
-class RingBuffer:
-    def __init__(self, size):
-        self.data = [0 for i in range(size)]
+class SweepWindow(pg.GraphicsLayoutWidget):
+    # Sweep curves with the best model fit of each drawn dashed over them, its
+    # residuals in a plot below and the fitted parameters under that
+    def __init__(self):
+        super().__init__(title='Sweep plot')
+        self.plotItem = self.addPlot(row=0, col=0)
+        self.plotItem.setLabel('bottom', text='Voltage', units='V')
+        self.plotItem.setLabel('left', text='Current (µA)')
+        self.plotItem.setTitle('Sweep plot')
+        self.residualPlot = self.addPlot(row=1, col=0)
+        self.residualPlot.setLabel('bottom', text='Current (µA)')
+        self.residualPlot.setLabel('left', text='Fit residual', units='V')
+        self.residualPlot.setMaximumHeight(150)
+        self.fitLabel = self.addLabel(row=2, col=0, justify='left')
+        self.fitLines = []
+        self.closed = False
+        self.resize(800, 600)
+        self.show()
+
+    def closeEvent(self, event):
+        self.closed = True
+        super().closeEvent(event)
+
+    def getPlotItem(self):
+        return self.plotItem
+
+    def plot(self, *args, **kwargs):
+        return self.plotItem.plot(*args, **kwargs)
+
+    def addFits(self, curve, fits):
+        if (len(fits) == 0):
+            return
+        best = fits[0]
+        pen = pg.mkPen(curve.opts['pen'])
+        self.residualPlot.plot(best['current'], best['residuals'], pen=pen)
+        pen.setStyle(QtCore.Qt.DashLine)
+        self.plotItem.plot(modelVoltage(best, best['current']), best['current'], pen=pen)
+        name = curve.name() or "Sweep " + str(len(self.fitLines) + 1)
+        self.fitLines.append(name + ": " + describeFit(best))
+        self.fitLabel.setText("<br>".join(self.fitLines))
+
+    def addMinMax(self, curve, nmax, nmin):
+        # Shades the area between the minimum and maximum curves
+        pmax = pg.PlotCurveItem(nmax['volts'],nmax['current'], pen=(196,196,196,128))
+        pmin = pg.PlotCurveItem(nmin['volts'], nmin['current'], pen=(196,196,196,128))
+        pfill = pg.FillBetweenItem(pmin, pmax, pg.mkBrush((128,128,128,128)),(128,0,0,128))
+
+        plot = curve.getViewBox()
+        plot.addItem(pmax)
+        plot.addItem(pmin)
+        plot.addItem(pfill)
+
+
+class LibraryDialog(QtWidgets.QDialog):
+    # Lists the stored sweeps, newest first, narrowed by name, device, mode,
+    # best fitting model and age. The selected ones are handed to `open` as
+    # (rows, newWindow) to be drawn.
+    def __init__(self, library, open):
+        super().__init__()
+        self.library = library
+        self.open = open
+        self.rows = []
+        self.setWindowTitle("Sweep library")
+        self.resize(900, 500)
+
+        self.nameFilter = QtWidgets.QLineEdit()
+        self.nameFilter.setPlaceholderText("Name contains")
+        self.deviceFilter = QtWidgets.QLineEdit()
+        self.deviceFilter.setPlaceholderText("Device")
+        self.modeFilter = QtWidgets.QComboBox()
+        self.modeFilter.addItems(["Any mode"] + sweepModeNames)
+        self.modelFilter = QtWidgets.QComboBox()
+        self.modelFilter.addItems(["Any fit", "resistor", "diode", "knee"])
+        self.sinceEnabled = QtWidgets.QCheckBox("Since")
+        self.sinceInput = QtWidgets.QDateEdit(QtCore.QDate.currentDate().addMonths(-1))
+        self.sinceInput.setCalendarPopup(True)
+        self.nameFilter.textChanged.connect(self.refresh)
+        self.deviceFilter.textChanged.connect(self.refresh)
+        self.modeFilter.currentIndexChanged.connect(self.refresh)
+        self.modelFilter.currentIndexChanged.connect(self.refresh)
+        self.sinceEnabled.stateChanged.connect(self.refresh)
+        self.sinceInput.dateChanged.connect(self.refresh)
+        filterRow = QtWidgets.QHBoxLayout()
+        for widget in (self.nameFilter, self.deviceFilter, self.modeFilter, self.modelFilter, self.sinceEnabled,
+                       self.sinceInput):
+            filterRow.addWidget(widget)
+
+        self.table = QtWidgets.QTableWidget()
+        self.table.setColumnCount(10)
+        self.table.setHorizontalHeaderLabels(["Time", "Name", "Device", "Start (μA)", "End (μA)", "Step (μA)",
+                                              "Dwell (ms)", "Mode", "Points", "Best fit"])
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.verticalHeader().setVisible(False)
+        self.table.doubleClicked.connect(lambda: self.openSelected(False))
+
+        self.countLabel = QtWidgets.QLabel()
+        self.btnOverlay = QtWidgets.QPushButton("Overlay")
+        self.btnOverlay.clicked.connect(lambda: self.openSelected(False))
+        self.btnNewWindow = QtWidgets.QPushButton("New window")
+        self.btnNewWindow.clicked.connect(lambda: self.openSelected(True))
+        self.btnDelete = QtWidgets.QPushButton("Delete")
+        self.btnDelete.clicked.connect(self.deleteSelected)
+        buttonRow = QtWidgets.QHBoxLayout()
+        buttonRow.addWidget(self.countLabel)
+        buttonRow.addStretch()
+        buttonRow.addWidget(self.btnDelete)
+        buttonRow.addWidget(self.btnNewWindow)
+        buttonRow.addWidget(self.btnOverlay)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(filterRow)
+        layout.addWidget(self.table)
+        layout.addLayout(buttonRow)
+
+    def conditions(self):
+        conditions = {}
+        if (self.nameFilter.text() != ""):
+            conditions['name'] = self.nameFilter.text()
+        if (self.deviceFilter.text() != ""):
+            conditions['device'] = self.deviceFilter.text()
+        if (self.modeFilter.currentIndex() > 0):
+            conditions['mode'] = self.modeFilter.currentIndex() - 1
+        if (self.modelFilter.currentIndex() > 0):
+            conditions['model'] = self.modelFilter.currentText()
+        if (self.sinceEnabled.isChecked()):
+            conditions['since'] = QtCore.QDateTime(self.sinceInput.date()).toSecsSinceEpoch()
+        return conditions
+
+    def refresh(self):
+        try:
+            self.rows = self.library.find(**self.conditions())
+        except sqlite3.Error as exc:
+            showError("Sweep library", "Searching the sweep library failed.", str(exc))
+            return
+        self.table.setRowCount(len(self.rows))
+        for i, row in enumerate(self.rows):
+            texts = [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row['created'])), row['name'], row['device'],
+                     "{0:g}".format(row['start']), "{0:g}".format(row['end']), "{0:g}".format(row['step']),
+                     "{0:g}".format(1000 * row['dwell']), sweepModeNames[row['mode']], str(row['points']),
+                     row['model'] or ""]
+            for column, text in enumerate(texts):
+                self.table.setItem(i, column, QtWidgets.QTableWidgetItem(text))
+        self.countLabel.setText(str(len(self.rows)) + " sweeps")
+
+    def selectedRows(self):
+        return [self.rows[index.row()] for index in self.table.selectionModel().selectedRows()]
+
+    def openSelected(self, newWindow):
+        rows = self.selectedRows()
+        if (len(rows) > 0):
+            self.open(rows, newWindow)
+
+    def deleteSelected(self):
+        rows = self.selectedRows()
+        if (len(rows) == 0):
+            return
+        answer = QtWidgets.QMessageBox.question(self, "Sweep library", "Delete {0} sweeps?".format(len(rows)))
+        if (answer != QtWidgets.QMessageBox.Yes):
+            return
+        try:
+            for row in rows:
+                self.library.delete(row['id'])
+        except (OSError, sqlite3.Error) as exc:
+            showError("Sweep library", "Deleting sweeps failed.", str(exc))
+        self.refresh()
+
+
+class PerformancePanel(QtWidgets.QWidget):
+    # Shows metric reports as they come in, and starts and stops logging them
+    # to CSV through `setLog`, which takes a path or None
+    closed = QtCore.pyqtSignal()
 
-    def append(self, x):
-        self.data.pop(0)
-        self.data.append(x)
+    def __init__(self, setLog, setInterval):
+        super().__init__()
+        self.setLog = setLog
+        self.setWindowTitle("Performance")
+        self.resize(450, 600)
+
+        self.reportLabel = QtWidgets.QLabel()
+        self.reportLabel.setAlignment(QtCore.Qt.AlignTop)
+        self.reportLabel.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
+        scroll = QtWidgets.QScrollArea()
+        scroll.setWidgetResizable(True)
+        scroll.setWidget(self.reportLabel)
+
+        self.intervalInput = QtWidgets.QSpinBox()
+        self.intervalInput.setRange(1, 3600)
+        self.intervalInput.setSuffix(" s")
+        self.intervalInput.valueChanged.connect(setInterval)
+        self.btnLog = QtWidgets.QPushButton("Log to CSV")
+        self.btnLog.setCheckable(True)
+        self.btnLog.clicked.connect(self.logClick)
+        self.logLabel = QtWidgets.QLabel()
+        controls = QtWidgets.QHBoxLayout()
+        controls.addWidget(QtWidgets.QLabel("Every"))
+        controls.addWidget(self.intervalInput)
+        controls.addWidget(self.btnLog)
+        controls.addWidget(self.logLabel)
+        controls.addStretch()
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(controls)
+        layout.addWidget(scroll)
+
+    def logClick(self):
+        if (not self.btnLog.isChecked()):
+            self.setLog(None)
+            self.logLabel.setText("")
+            return
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Log metrics", "", "CSV files (*.csv)")
+        if (path == "" or not self.setLog(path)):
+            self.btnLog.setChecked(False)
+            return
+        self.logLabel.setText(os.path.basename(path))
+
+    def showReports(self, reports, seconds):
+        # reports as (source, rows) over the last `seconds`
+        text = []
+        for source, rows in reports:
+            text.append("<b>" + source + "</b>")
+            text.extend(describeReport(rows, seconds))
+            text.append("")
+        self.reportLabel.setText("<br>".join(text))
 
-    def get(self):
-        return self.data
+    def closeEvent(self, event):
+        self.closed.emit()
+        super().closeEvent(event)
 
 
 # TODO: Popups for error
@@ -40,29 +270,66 @@ class MyApp(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
 
-        self.serialLock = threading.Lock()
-
         self.current = 0
 
         self.highVoltage = True
         self.highCurrent = False
 
-        self.serialPort = "COM5"
+        # "auto" probes every serial port for boards
+        self.serialPort = "auto"
         self.serialSpeed = 14400
-        self.serial = serial.Serial()
+        self.binary = False
+        self.samplePeriod = defaultSamplePeriod
+        self.oversampling = 1
+        self.calibration = defaultCalibration
+        # All open boards, and the one the live plots and readouts show
+        self.devices = DeviceManager(samplesToStore)
+        self.device = None
+        # Whether the ports being opened were all probed for boards
+        self.probing = False
+        self.recording = False
+        self.replay = None
+        self.replaySpeed = 1.0
 
         # Default values for sweeping
         self.sweepStart = 0
         self.sweepEnd = 1000
         self.sweepStep = 1
-        self.sweepEnabled = False
         self.sweepInterval = 200
-        self.sweepValuesVolts = []
-        self.sweepValuesCurrent = []
-        self.sweepValues = []
+        self.sweepMode = sweepFixed
+        self.settleTolerance = 2
+        self.settleSamples = 5
+        # Sweep curves of running sweeps by device, None until the first point
+        self.sweepCurves = {}
+        # Finished sweeps waiting for their final curves from the worker
+        # processes, as (window, curve, device, engine, future, time submitted)
+        self.sweepAnalyses = []
+        self.sweepSettleTimes = []
+        self.sweepName = ""
+
+        # Finished sweeps are stored here to be reopened later
+        try:
+            self.library = SweepLibrary()
+        except (OSError, sqlite3.Error) as exc:
+            self.library = None
+            showError("Sweep library", "Could not open the sweep library, sweeps will not be stored.", str(exc))
+        self.libraryDialog = None
 
         self.plotwindow = None
+        self.sweepWindows = []
         self.sweepPen = 1
+        self.sweepNewWindowPending = False
+
+        self.frameRate = 20
+        self.plotsDirty = False
+
+        # Time spent updating and drawing and between updates, shown with
+        # the boards' and sweeps' metrics in the performance panel
+        self.metrics = Metrics()
+        self.lastUpdate = None
+        self.metricsLog = None
+        self.metricsReported = time.monotonic()
+        self.performancePanel = None
 
         self.setWindowTitle("IV-grapher")
 
@@ -81,6 +348,19 @@ class MyApp(QtWidgets.QWidget):
         self.currentErrorPlot.setYRange(-2, 2)
         self.currentErrorPlot.setLabel("left", text="Current (μA)")
 
+        # The live curves are created once and updated in place. The x axis is
+        # the sample number since connecting, and only the visible part of the
+        # history is drawn, from a decimation level matching the plot width.
+        self.livePlots = (self.voltagePlot, self.currentPlot, self.currentErrorPlot)
+        for plot in self.livePlots:
+            plot.setXRange(0, samplesShown, padding=0)
+            plot.setLabel("bottom", text="Sample")
+            plot.sigXRangeChanged.connect(self.viewChange)
+        self.voltageCurve = self.voltagePlot.plot(pen=3)
+        self.currentCurve = self.currentPlot.plot(pen=2)
+        self.currentErrorCurve = self.currentErrorPlot.plot(pen=1)
+        self.shownNewest = 0
+
         # Default grid layout
         self.layout = QtWidgets.QGridLayout()
         self.setLayout(self.layout)
@@ -120,6 +400,26 @@ class MyApp(QtWidgets.QWidget):
         self.avgVoltageLabel.setText("0V")
         label_layout.addRow(QtWidgets.QLabel("Average voltage: "), self.avgVoltageLabel)
 
+        self.voltageRangeLabel = QtWidgets.QLabel()
+        self.voltageRangeLabel.setText("0V / 0V")
+        label_layout.addRow(QtWidgets.QLabel("Min/max voltage: "), self.voltageRangeLabel)
+
+        self.voltageNoiseLabel = QtWidgets.QLabel()
+        self.voltageNoiseLabel.setText("0mV")
+        label_layout.addRow(QtWidgets.QLabel("Voltage noise (σ): "), self.voltageNoiseLabel)
+
+        self.currentErrorRmsLabel = QtWidgets.QLabel()
+        self.currentErrorRmsLabel.setText("0μA")
+        label_layout.addRow(QtWidgets.QLabel("Current error RMS: "), self.currentErrorRmsLabel)
+
+        self.droppedLabel = QtWidgets.QLabel()
+        self.droppedLabel.setText("0")
+        label_layout.addRow(QtWidgets.QLabel("Dropped samples: "), self.droppedLabel)
+
+        self.malformedLabel = QtWidgets.QLabel()
+        self.malformedLabel.setText("0")
+        label_layout.addRow(QtWidgets.QLabel("Malformed lines/frames: "), self.malformedLabel)
+
         # Controls for high/low voltage and current
         scaling_control_layout = QtWidgets.QFormLayout()
         self.highVoltageInput = QtWidgets.QCheckBox("High voltage mode")
@@ -131,6 +431,16 @@ class MyApp(QtWidgets.QWidget):
         scaling_control_layout.addRow(self.highVoltageInput)
         scaling_control_layout.addRow(self.highCurrentInput)
 
+        frame_rate_row = QtWidgets.QHBoxLayout()
+        self.frameRateInput = QtWidgets.QLineEdit(str(self.frameRate))
+        self.frameRateInput.setMaximumSize(QSize(50, 16777215))
+        self.frameRateInput.setAlignment(QtCore.Qt.AlignRight)
+        self.frameRateInput.setValidator(QtGui.QIntValidator(1, 100))
+        self.frameRateInput.editingFinished.connect(self.frameRateChange)
+        frame_rate_row.addWidget(self.frameRateInput)
+        frame_rate_row.addWidget(QtWidgets.QLabel("fps"))
+        scaling_control_layout.addRow(QtWidgets.QLabel("Max frame rate: "), frame_rate_row)
+
         # Control buttons for serial
         serial_control_layout = QtWidgets.QFormLayout()
         self.serialPortInput = QtWidgets.QLineEdit(self.serialPort)
@@ -141,14 +451,79 @@ class MyApp(QtWidgets.QWidget):
         serial_control_layout.addRow(QtWidgets.QLabel("Serial port"), self.serialPortInput)
         serial_control_layout.addRow(QtWidgets.QLabel("Speed"), self.serialSpeedInput)
 
+        sample_period_row = QtWidgets.QHBoxLayout()
+        self.samplePeriodInput = QtWidgets.QLineEdit(str(self.samplePeriod / 1000))
+        self.samplePeriodInput.setMaximumSize(QSize(60, 16777215))
+        self.samplePeriodInput.setAlignment(QtCore.Qt.AlignRight)
+        self.samplePeriodInput.setValidator(QtGui.QDoubleValidator(0.2, 262.1, 3))
+        self.samplePeriodInput.editingFinished.connect(self.samplingChange)
+        sample_period_row.addWidget(self.samplePeriodInput)
+        sample_period_row.addWidget(QtWidgets.QLabel("ms"))
+        serial_control_layout.addRow(QtWidgets.QLabel("Sample period"), sample_period_row)
+
+        self.oversamplingInput = QtWidgets.QLineEdit(str(self.oversampling))
+        self.oversamplingInput.setAlignment(QtCore.Qt.AlignRight)
+        self.oversamplingInput.setValidator(QtGui.QIntValidator(1, 64))
+        self.oversamplingInput.editingFinished.connect(self.samplingChange)
+        serial_control_layout.addRow(QtWidgets.QLabel("Oversampling"), self.oversamplingInput)
+
+        self.sampleRateLabel = QtWidgets.QLabel()
+        self.sampleRateLabel.setAlignment(QtCore.Qt.AlignRight)
+        serial_control_layout.addRow(QtWidgets.QLabel("Effective rate"), self.sampleRateLabel)
+        self.showSampleRate()
+
+        self.binaryInput = QtWidgets.QCheckBox("Binary protocol")
+        self.binaryInput.setChecked(self.binary)
+        self.binaryInput.stateChanged.connect(self.binaryChange)
+        serial_control_layout.addRow(self.binaryInput)
+
+        self.deviceInput = QtWidgets.QComboBox()
+        self.deviceInput.currentIndexChanged.connect(self.deviceChange)
+        serial_control_layout.addRow(QtWidgets.QLabel("Shown device"), self.deviceInput)
+
+        self.btnCalibration = QtWidgets.QPushButton("Load calibration")
+        self.btnCalibration.clicked.connect(self.loadCalibration)
+        self.calibrationLabel = QtWidgets.QLabel("Default")
+        serial_control_layout.addRow(self.btnCalibration, self.calibrationLabel)
+
         self.btnSerialToggle = QtWidgets.QPushButton("Open serial")
         self.btnSerialToggle.clicked.connect(self.serialButtonClick)
         serial_control_layout.addRow(self.btnSerialToggle)
+        self.connectionLabel = QtWidgets.QLabel()
+        serial_control_layout.addRow(self.connectionLabel)
+
+        # Recording to and replaying from capture files
+        capture_layout = QtWidgets.QFormLayout()
+        self.btnRecordToggle = QtWidgets.QPushButton("Record to file")
+        self.btnRecordToggle.clicked.connect(self.recordButtonClick)
+        capture_layout.addRow(self.btnRecordToggle)
+
+        replay_row = QtWidgets.QHBoxLayout()
+        self.btnReplayToggle = QtWidgets.QPushButton("Replay file")
+        self.btnReplayToggle.clicked.connect(self.replayButtonClick)
+        replay_row.addWidget(self.btnReplayToggle)
+        self.replaySpeedInput = QtWidgets.QLineEdit(str(self.replaySpeed))
+        self.replaySpeedInput.setMaximumSize(QSize(50, 16777215))
+        self.replaySpeedInput.setAlignment(QtCore.Qt.AlignRight)
+        self.replaySpeedInput.setValidator(QtGui.QDoubleValidator(0.01, 10000.0, 2))
+        replay_row.addWidget(self.replaySpeedInput)
+        replay_row.addWidget(QtWidgets.QLabel("x"))
+        capture_layout.addRow(replay_row)
+
+        self.captureLabel = QtWidgets.QLabel()
+        capture_layout.addRow(self.captureLabel)
+
+        self.btnPerformance = QtWidgets.QPushButton("Performance")
+        self.btnPerformance.setCheckable(True)
+        self.btnPerformance.clicked.connect(self.performanceClick)
+        capture_layout.addRow(self.btnPerformance)
 
         left_column_layout.addStretch()
         left_column_layout.addLayout(scaling_control_layout)
         left_column_layout.addWidget(HBar())
         left_column_layout.addLayout(serial_control_layout)
+        left_column_layout.addWidget(HBar())
+        left_column_layout.addLayout(capture_layout)
 
         # Sweep settings
         sweep_layout = QtWidgets.QFormLayout()
@@ -162,6 +537,10 @@ class MyApp(QtWidgets.QWidget):
 
         self.sweepProgressBar = QtWidgets.QProgressBar()
 
+        self.btnLibrary = QtWidgets.QPushButton("Sweep library")
+        self.btnLibrary.clicked.connect(self.showLibrary)
+        self.btnLibrary.setEnabled(self.library is not None)
+
         start_sweep_row = QtWidgets.QHBoxLayout()
         self.sweepStartInput = QtWidgets.QLineEdit(str(self.sweepStart / 10))
         self.sweepStartInput.setMaximumSize(QSize(50, 16777215))
@@ -198,6 +577,26 @@ class MyApp(QtWidgets.QWidget):
         time_sweep_row.addWidget(QtWidgets.QLabel("ms"))
         sweep_layout.addRow(QtWidgets.QLabel("Time steps:"), time_sweep_row)
 
+        self.sweepModeInput = QtWidgets.QComboBox()
+        self.sweepModeInput.addItems(sweepModeNames)
+        self.sweepModeInput.setCurrentIndex(self.sweepMode)
+        sweep_layout.addRow(QtWidgets.QLabel("Sweep mode:"), self.sweepModeInput)
+
+        settle_row = QtWidgets.QHBoxLayout()
+        self.settleToleranceInput = QtWidgets.QLineEdit(str(self.settleTolerance))
+        self.settleToleranceInput.setMaximumSize(QSize(50, 16777215))
+        self.settleToleranceInput.setAlignment(QtCore.Qt.AlignRight)
+        self.settleToleranceInput.setValidator(QtGui.QDoubleValidator(0.0, 10000.0, 2))
+        settle_row.addWidget(self.settleToleranceInput)
+        settle_row.addWidget(QtWidgets.QLabel("mV over"))
+        self.settleSamplesInput = QtWidgets.QLineEdit(str(self.settleSamples))
+        self.settleSamplesInput.setMaximumSize(QSize(40, 16777215))
+        self.settleSamplesInput.setAlignment(QtCore.Qt.AlignRight)
+        self.settleSamplesInput.setValidator(QtGui.QIntValidator(1, 1000))
+        settle_row.addWidget(self.settleSamplesInput)
+        settle_row.addWidget(QtWidgets.QLabel("samples"))
+        sweep_layout.addRow(QtWidgets.QLabel("Settled within:"), settle_row)
+
         sweep_name_label = QtWidgets.QLabel("Sweep name")
         self.sweepNameInput = QtWidgets.QLineEdit("")
         self.sweepNameInput.setMaximumSize(QSize(150, 16777215))
@@ -215,6 +614,10 @@ class MyApp(QtWidgets.QWidget):
         sweep_layout.addRow(self.btnSweepStart)
         sweep_layout.addRow(self.btnSweepStop)
         sweep_layout.addRow(self.sweepProgressBar)
+        sweep_layout.addRow(self.btnLibrary)
+
+        self.settleSummaryLabel = QtWidgets.QLabel()
+        sweep_layout.addRow(self.settleSummaryLabel)
 
         bottomRightLayout = QtWidgets.QHBoxLayout()
         bottomRightLayout.addLayout(left_column_layout)
@@ -225,81 +628,286 @@ class MyApp(QtWidgets.QWidget):
 
         self.layout.addLayout(bottomRightLayout, 1, 1)
 
-        # Set up buffers for data storage
-        self.x = numpy.arange(samplesToStore)
-        self.dropSamples = RingBuffer(samplesToStore)
-        self.currentSamples = RingBuffer(samplesToStore)
-        self.currentSetSamples = RingBuffer(samplesToStore)
-        self.currentErrorSamples = RingBuffer(samplesToStore)
-
         self.timer = QTimer()
         self.timer.setInterval(100)
         self.timer.timeout.connect(self.update)
 
+        # Redrawing runs on its own timer so the frame rate can be capped
+        # independently of how often samples are taken from the reader
+        self.frameTimer = QTimer()
+        self.frameTimer.setInterval(int(1000 / self.frameRate))
+        self.frameTimer.timeout.connect(self.render)
+
+        # Picks up boards as their ports are opened in the background
+        self.connectTimer = QTimer()
+        self.connectTimer.setInterval(50)
+        self.connectTimer.timeout.connect(self.connectProgress)
+
+        # Fires when the sweep engine next needs polling
         self.sweepTimer = QTimer()
-        self.sweepTimer.setInterval(self.sweepInterval)
+        self.sweepTimer.setSingleShot(True)
         self.sweepTimer.timeout.connect(self.sweep)
 
+        # Picks up the final curves of finished sweeps, also after the port
+        # or replay has been closed
+        self.analysisTimer = QTimer()
+        self.analysisTimer.setInterval(100)
+        self.analysisTimer.timeout.connect(self.collectAnalyses)
+
+        # Reports metrics while the performance panel is open or they are logged
+        self.metricsTimer = QTimer()
+        self.metricsTimer.setInterval(1000)
+        self.metricsTimer.timeout.connect(self.reportMetrics)
+
         # self.timer2 = QTimer()
         # self.timer2.setInterval(5000)
         # self.timer2.timeout.connect(self.randomDAC)
         # self.timer2.start(5000)
 
     def highVoltageChange(self):
-        if self.serial.is_open:
-            if self.serialLock.acquire(timeout=5):
-                self.highVoltage = self.highVoltageInput.isChecked()
-                if (self.highVoltage):
-                    self.serial.write('V'.encode('ascii'))
-                else:
-                    self.serial.write('v'.encode('ascii'))
-                self.serialLock.release()
+        if (len(self.devices.devices) > 0):
+            self.highVoltage = self.highVoltageInput.isChecked()
+            for device in self.devices.devices:
+                device.setVoltageRange(self.highVoltage)
         else:
             showError("Serial port not open.","Please open serial port first.")
             self.highVoltageInput.setChecked(self.highVoltage)
 
     def highCurrentChange(self):
-        if self.serial.is_open:
-            if self.serialLock.acquire(timeout=5):
-                self.highCurrent = self.highCurrentInput.isChecked()
-                if (self.highCurrent):
-                    self.serial.write('C'.encode('ascii'))
-                else:
-                    self.serial.write('c'.encode('ascii'))
-                self.serialLock.release()
+        if (len(self.devices.devices) > 0):
+            self.highCurrent = self.highCurrentInput.isChecked()
+            for device in self.devices.devices:
+                device.setRange(self.highCurrent)
         else:
             showError("Serial port not open.", "Please open serial port first.")
             self.highCurrentInput.setChecked(self.highCurrent)
 
+    def binaryChange(self):
+        binary = self.binaryInput.isChecked()
+        if (binary == self.binary):
+            return
+        try:
+            checkSampling(self.serialSpeed, binary, self.samplePeriod, self.oversampling)
+        except ValueError as exc:
+            showError("Sampling too fast.", "Text lines need a longer sample period.", str(exc))
+            self.binaryInput.setChecked(self.binary)
+            return
+        self.binary = binary
+        for device in self.devices.devices:
+            if (not device.replay):
+                device.reader.setBinary(self.binary)
+
+    def samplingChange(self):
+        # Only settings the serial port can carry, see checkSampling()
+        samplePeriod = int(1000 * float(self.samplePeriodInput.text()))
+        oversampling = int(self.oversamplingInput.text())
+        try:
+            checkSampling(self.serialSpeed, self.binary, samplePeriod, oversampling)
+        except ValueError as exc:
+            showError("Sampling too fast.", "The serial port cannot carry this many samples.", str(exc))
+            self.samplePeriodInput.setText(str(self.samplePeriod / 1000))
+            self.oversamplingInput.setText(str(self.oversampling))
+            return
+        self.samplePeriod = samplePeriod
+        self.oversampling = oversampling
+        self.showSampleRate()
+        for device in self.devices.devices:
+            if (not device.replay):
+                device.reader.setSampling(self.samplePeriod, self.oversampling)
+
+    def showSampleRate(self):
+        rate = 1_000_000 / (self.samplePeriod * self.oversampling)
+        self.sampleRateLabel.setText("{0:.1f}".format(rate) + " samples/s")
+
     def serialButtonClick(self):
-        if (self.serial.is_open):
+        if (self.replay is not None):
+            showError("Replay running.", "Please stop the replay first.")
+            return
+        if (len(self.devices.devices) > 0 or len(self.devices.opening) > 0):
             self.stopSerial()
         else:
             self.startSerial()
         return
 
     def startSerial(self):
-        if self.serialLock.acquire():
-            self.serialPort=self.serialPortInput.text()
-            self.serialSpeed=int(self.serialSpeedInput.text())
-            try:
-                self.serial = serial.Serial(self.serialPort, self.serialSpeed, timeout=5)
-            except serial.SerialException as exc:
-                showError("Opening serial port failed", "Tried to open " + self.serialPort + " and failed.", str(exc))
+        # Several boards can be opened at once, with their ports separated by
+        # commas. Ports are opened in the background and the boards show up as
+        # they answer, see connectProgress().
+        self.serialPort=self.serialPortInput.text()
+        self.serialSpeed=int(self.serialSpeedInput.text())
+        ports = [port.strip() for port in self.serialPort.split(",") if port.strip() != ""]
+        self.probing = len(ports) == 0 or ports == ["auto"]
+        if (self.probing):
+            ports = candidatePorts()
+            if (len(ports) == 0):
+                showError("No serial ports", "No serial ports were found.")
                 return
+        try:
+            self.devices.startOpening(ports, self.serialSpeed, self.binary, self.samplePeriod, self.oversampling,
+                                      self.calibration, report=not self.probing)
+        except ValueError as exc:
+            showError("Sampling too fast.", "The serial port cannot carry this many samples, please lower the "
+                      "sample rate or raise the speed.", str(exc))
+            return
+        self.btnSerialToggle.setText("Cancel")
+        self.connectTimer.start()
+        self.connectProgress()
+
+    def connectProgress(self):
+        opened, failures = self.devices.finishOpening()
+        if (len(opened) > 0):
+            self.showDevices()
             self.btnSerialToggle.setText("Close serial")
-            self.serial.readline()
-            self.serial.readline()
-            self.serial.timeout = 0.05
-            self.timer.start(100)
-            self.serialLock.release()
+            if (not self.timer.isActive()):
+                self.lastUpdate = None
+                self.timer.start(100)
+                self.frameTimer.start()
+        if (len(failures) > 0):
+            showError("Opening serial port failed", "Tried to open " + ", ".join(port for port, exc in failures) +
+                      " and failed.", "\n".join(str(exc) for port, exc in failures))
+        pending = len(self.devices.opening)
+        if (pending > 0):
+            self.connectionLabel.setText("{0} ports, {1} left...".format("Probing" if self.probing else "Opening",
+                                                                         pending))
+            return
+        self.connectTimer.stop()
+        self.showConnection()
+        if (len(self.devices.devices) == 0):
+            self.btnSerialToggle.setText("Open serial")
+            if (self.probing):
+                showError("No IV-grapher found", "No IV-grapher answered on any serial port.")
+
+    def showConnection(self):
+        boards = [device for device in self.devices.devices if not device.replay]
+        reconnecting = [device.name for device in boards if device.reader.reconnecting]
+        if (len(reconnecting) > 0):
+            self.connectionLabel.setText("Reconnecting " + ", ".join(reconnecting))
+        elif (len(boards) > 0):
+            self.connectionLabel.setText(", ".join(device.name + " (firmware " + device.reader.identity['version']
+                                                   + ")" for device in boards))
+        else:
+            self.connectionLabel.setText("")
 
     def stopSerial(self):
-        if self.serialLock.acquire():
-            self.timer.stop()
-            self.serial.close()
-            self.serialLock.release()
-            self.btnSerialToggle.setText("Open serial")
+        self.connectTimer.stop()
+        self.devices.cancelOpening()
+        self.stopSweep()
+        if (self.recording):
+            self.stopRecording()
+        self.timer.stop()
+        self.frameTimer.stop()
+        self.devices.close()
+        self.showDevices()
+        self.showConnection()
+        self.btnSerialToggle.setText("Open serial")
+
+    def loadCalibration(self):
+        # Applies to the open boards right away and to the ones opened later
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Load calibration", "", "Calibrations (*.json)")
+        if (path == ""):
+            return
+        try:
+            self.calibration = Calibration.load(path)
+        except (OSError, ValueError, KeyError) as exc:
+            showError("Loading calibration failed", "Could not read " + path + ".", str(exc))
+            return
+        self.calibrationLabel.setText(os.path.basename(path))
+        for device in self.devices.devices:
+            if (not device.replay):
+                device.reader.calibration = self.calibration
+
+    def showDevices(self):
+        self.deviceInput.blockSignals(True)
+        self.deviceInput.clear()
+        self.deviceInput.addItems([device.name for device in self.devices.devices])
+        self.deviceInput.blockSignals(False)
+        self.deviceChange()
+
+    def deviceChange(self):
+        index = self.deviceInput.currentIndex()
+        self.device = self.devices.devices[index] if index >= 0 else None
+        self.shownNewest = 0
+        self.plotsDirty = True
+
+    def recordButtonClick(self):
+        if (self.recording):
+            self.stopRecording()
+        else:
+            self.startRecording()
+
+    def startRecording(self):
+        # With several boards each gets its own file, named after its port
+        if (len(self.devices.devices) == 0):
+            showError("Serial port not open.", "Please open serial port first.")
+            return
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Record to file", "", "Captures (*.ivcap)")
+        if (path == ""):
+            return
+        base, extension = os.path.splitext(path)
+        for device in self.devices.devices:
+            devicePath = path
+            if (len(self.devices.devices) > 1):
+                devicePath = base + "-" + re.sub(r"[^\w.-]", "_", device.name) + extension
+            settings = {'serialPort': device.name, 'serialSpeed': self.serialSpeed, 'binary': self.binary,
+                        'samplePeriod': self.samplePeriod, 'oversampling': self.oversampling,
+                        'highVoltage': self.highVoltage, 'highCurrent': device.highCurrent}
+            try:
+                device.recorder = CaptureWriter(devicePath, settings, device.reader.calibration)
+            except OSError as exc:
+                showError("Recording failed", "Could not create " + devicePath + ".", str(exc))
+                continue
+            device.recorder.start()
+            device.reader.recorder = device.recorder
+        self.recording = True
+        self.btnRecordToggle.setText("Stop recording")
+
+    def stopRecording(self):
+        written = 0
+        for device in self.devices.devices:
+            if (device.recorder is not None):
+                device.reader.recorder = None
+                device.recorder.stop()
+                written += device.recorder.samplesWritten
+                device.recorder = None
+        self.captureLabel.setText("Recorded " + str(written) + " samples")
+        self.recording = False
+        self.btnRecordToggle.setText("Record to file")
+
+    def replayButtonClick(self):
+        if (self.replay is not None):
+            self.stopReplay()
+        else:
+            self.startReplay()
+
+    def startReplay(self):
+        if (len(self.devices.devices) > 0 or len(self.devices.opening) > 0):
+            showError("Serial port open.", "Please close serial port before replaying a capture.")
+            return
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Replay file", "", "Captures (*.ivcap)")
+        if (path == ""):
+            return
+        self.replaySpeed = float(self.replaySpeedInput.text())
+        try:
+            self.replay = CaptureReplay(path, self.replaySpeed)
+        except (OSError, ValueError) as exc:
+            showError("Replay failed", "Could not read " + path + ".", str(exc))
+            return
+        self.devices.addReplay(os.path.basename(path), self.replay)
+        self.showDevices()
+        self.btnReplayToggle.setText("Stop replay")
+        self.lastUpdate = None
+        self.timer.start(100)
+        self.frameTimer.start()
+
+    def stopReplay(self):
+        self.timer.stop()
+        self.frameTimer.stop()
+        self.render()
+        self.stopSweep()
+        self.devices.close()
+        self.showDevices()
+        self.replay = None
+        self.btnReplayToggle.setText("Replay file")
 
     def createButtons(self):
         self.btnIncrease = QtWidgets.QPushButton('+0.1 μA')
@@ -327,79 +935,176 @@ class MyApp(QtWidgets.QWidget):
         self.btnLayout.addWidget(QtWidgets.QSplitter())
 
     def update(self):
-        self.readADC()
-        self.voltagePlot.plot(self.x, self.dropSamples.get(), clear=1, pen=3)
-        self.currentPlot.plot(self.x, self.currentSamples.get(), clear=1, pen=2)
-        self.currentErrorPlot.plot(self.x, self.currentErrorSamples.get(), clear=1, pen=1)
-
-    def readADC(self):
-        while (self.serial.in_waiting > 5):
-            line = self.serial.readline()
-            line = line.decode('ascii')
-            linesplit = line.split(';')
-
-            highVoltage = int(linesplit[3])
-            highCurrent = int(linesplit[4])
-            currentSet = (int(linesplit[0])+staticCalAddition)*(1+(99*highCurrent))/10
-            voltageDrop = (int(linesplit[1])+staticCalAddition)*(1+(9*highVoltage))/1000
-            currentRead = (int(linesplit[2])+staticCalAddition)*(1+(99*highCurrent))/10
-
-            # The device leaks approx. 1µA per volt through the differential amplifier input
-            correctedCurrent = int(10*(currentRead - voltageDrop))/10
-            if (correctedCurrent<0):
-                correctedCurrent = 0.0
-
-            self.currentSetSamples.append(currentSet)
-            self.dropSamples.append(voltageDrop)
-            self.currentSamples.append(currentRead)
-            self.currentErrorSamples.append(currentRead - currentSet)
-
-            self.setCurrentLabel.setText(str(currentSet) + "μA")
-            self.voltageLabel.setText(str(voltageDrop) + "V")
-            self.currentLabel.setText(str(currentRead) + "μA")
-            self.correctedCurrentLabel.setText(str(correctedCurrent) + "μA")
-            if (currentRead != 0):
-                self.resistanceLabel.setText("{0:.2f}".format(voltageDrop/(currentRead/1_000_000)) + "Ω")
-            else:
-                self.resistanceLabel.setText("∞ Ω")
-            self.avgVoltageLabel.setText("{0:.4f}".format(numpy.nanmean(self.dropSamples.get())) + "V")
-
-            if (self.sweepEnabled):
-                self.sweepValuesVolts.append(voltageDrop)
-                self.sweepValuesCurrent.append(correctedCurrent)
-                self.sweepValues.append((voltageDrop, correctedCurrent))
-        return
+        started = time.perf_counter()
+        if (self.lastUpdate is not None):
+            self.metrics.observe("update interval", 1000 * (started - self.lastUpdate), "ms")
+        self.lastUpdate = started
+        self.updateDevices()
+        self.metrics.timing("update", started)
+
+    def updateDevices(self):
+        for device, error in self.devices.poll():
+            if (device in self.sweepCurves):
+                self.finishSweep(device)
+            self.devices.close(device)
+            self.showDevices()
+            showError("Serial port failed", "Reading from " + device.name + " failed.", str(error))
+        if (len(self.devices.devices) == 0):
+            if (len(self.devices.opening) == 0):
+                self.stopSerial()
+            return
+        if (not self.connectTimer.isActive()):
+            self.showConnection()
+        # Only redrawn for new samples of the shown device
+        if (self.device is not None and self.device.store.dropHistory.count() != self.shownNewest):
+            self.plotsDirty = True
+        self.sweepProgress()
+        if (self.replay is not None and self.replay.finished()):
+            self.stopReplay()
+
+    def render(self):
+        if (not self.plotsDirty or self.device is None or self.device.store.statistics.latest is None):
+            return
+        started = time.perf_counter()
+        store = self.device.store
+        newest = store.dropHistory.count()
+        for plot in self.livePlots:
+            self.follow(plot, newest)
+        self.shownNewest = newest
+        self.plotsDirty = False
+        for plot, curve, history in ((self.voltagePlot, self.voltageCurve, store.dropHistory),
+                                     (self.currentPlot, self.currentCurve, store.currentHistory),
+                                     (self.currentErrorPlot, self.currentErrorCurve, store.currentErrorHistory)):
+            low, high = plot.viewRange()[0]
+            width = max(int(plot.getViewBox().width()), 100)
+            curve.setData(*history.view(numpy.floor(low), numpy.ceil(high) + 1, width))
+        self.refreshLabels()
+        self.renderSweep()
+        self.metrics.timing("render", started)
+
+    def follow(self, plot, newest):
+        # A plot showing the newest sample scrolls along with new ones. Once
+        # panned or zoomed away from them it stays put.
+        low, high = plot.viewRange()[0]
+        if (high >= self.shownNewest and newest > high):
+            plot.setXRange(low + newest - high, newest, padding=0)
+
+    def viewChange(self):
+        self.plotsDirty = True
+
+    def refreshLabels(self):
+        statistics = self.device.store.statistics
+        latest = statistics.latest
+        self.setCurrentLabel.setText(str(latest['currentSet']) + "μA")
+        self.voltageLabel.setText(str(latest['voltageDrop']) + "V")
+        self.currentLabel.setText(str(latest['currentRead']) + "μA")
+        self.correctedCurrentLabel.setText(str(statistics.correctedCurrent()) + "μA")
+        resistance = statistics.resistance()
+        if (resistance != numpy.inf):
+            self.resistanceLabel.setText("{0:.2f}".format(resistance) + "Ω")
+        else:
+            self.resistanceLabel.setText("∞ Ω")
+
+        drop = statistics.drop
+        self.avgVoltageLabel.setText("{0:.4f}".format(drop.mean()) + "V")
+        self.voltageRangeLabel.setText("{0:.3f}V / {1:.3f}V".format(drop.min(), drop.max()))
+        self.voltageNoiseLabel.setText("{0:.2f}".format(1000 * drop.std()) + "mV")
+        self.currentErrorRmsLabel.setText("{0:.2f}".format(statistics.currentError.rms()) + "μA")
+
+        reader = self.device.reader
+        if (not self.device.replay):
+            self.droppedLabel.setText(str(reader.droppedSamples + reader.parser.missed))
+            self.malformedLabel.setText(str(reader.parser.malformed))
+        if (self.recording):
+            written = sum(device.recorder.samplesWritten for device in self.devices.devices
+                          if device.recorder is not None)
+            self.captureLabel.setText("Recorded " + str(written) + " samples")
+        elif (self.replay is not None):
+            self.captureLabel.setText("Replayed {0} of {1} samples".format(self.replay.position,
+                                                                           len(self.replay.capture)))
+
+    def performanceClick(self):
+        if (self.performancePanel is None):
+            self.performancePanel = PerformancePanel(self.setMetricsLog, self.setMetricsInterval)
+            self.performancePanel.intervalInput.setValue(self.metricsTimer.interval() // 1000)
+            self.performancePanel.closed.connect(self.performanceClosed)
+        if (self.btnPerformance.isChecked()):
+            self.performancePanel.show()
+            self.reportMetrics()
+        else:
+            self.performancePanel.hide()
+        self.metricsTimerChange()
+
+    def performanceClosed(self):
+        self.btnPerformance.setChecked(False)
+        self.metricsTimerChange()
+
+    def metricsTimerChange(self):
+        if (self.btnPerformance.isChecked() or self.metricsLog is not None):
+            self.metricsTimer.start()
+        else:
+            self.metricsTimer.stop()
+
+    def setMetricsLog(self, path):
+        if (self.metricsLog is not None):
+            self.metricsLog.close()
+            self.metricsLog = None
+        if (path is not None):
+            try:
+                self.metricsLog = MetricsLog(path)
+            except OSError as exc:
+                showError("Logging failed", "Could not open " + path + ".", str(exc))
+                return False
+        self.metricsTimerChange()
+        return True
+
+    def setMetricsInterval(self, seconds):
+        self.metricsTimer.setInterval(1000 * seconds)
+
+    def metricSources(self):
+        return ([("GUI", self.metrics), ("Devices", self.devices.metrics)]
+                + [(device.name, device.reader.metrics) for device in self.devices.devices if not device.replay])
+
+    def reportMetrics(self):
+        now = time.monotonic()
+        seconds = max(now - self.metricsReported, 1e-3)
+        self.metricsReported = now
+        reports = [(source, metrics.report()) for source, metrics in self.metricSources()]
+        if (self.metricsLog is not None):
+            timestamp = time.time()
+            try:
+                for source, rows in reports:
+                    self.metricsLog.write(source, rows, timestamp)
+            except OSError as exc:
+                self.setMetricsLog(None)
+                self.performancePanel.btnLog.setChecked(False)
+                showError("Logging failed", "Writing the metrics log failed.", str(exc))
+        if (self.btnPerformance.isChecked()):
+            self.performancePanel.showReports(reports, seconds)
+
+    def frameRateChange(self):
+        self.frameRate = int(self.frameRateInput.text())
+        self.frameTimer.setInterval(int(1000 / self.frameRate))
 
     def writeDAC(self, data):
         # TODO: Data sanity on input
-        if (data > 4096):
-            # High current mode
-            data = int(data/100)
-            self.actualWriteDAC(data)
-            if (not self.highCurrent):
-                self.highCurrentInput.setChecked(True)
-        else:
-            # Low current mode
-            if (self.highCurrent):
-                self.highCurrentInput.setChecked(False)
-            self.actualWriteDAC(data)
-
-    def actualWriteDAC(self, data):
-        serdata = ("S" + str(data) + '\n').encode('ascii')
-        if self.serial.is_open:
-            if self.serialLock.acquire(timeout=3):
-                self.serial.write(serdata)
-                self.serialLock.release()
-            else:
-                showError("Serial port locked.", "Could not acquire serial port lock within 3 seconds.")
-        else:
+        if (len(self.devices.devices) == 0):
             showError("Serial port not open.", "Please open serial port first.")
-        return
+            return
+        for device in self.devices.devices:
+            device.setCurrent(data)
+        self.highCurrent = self.device.highCurrent
+        self.showHighCurrent()
+
+    def showHighCurrent(self):
+        # The range was already switched, so the checkbox must not send it again
+        self.highCurrentInput.blockSignals(True)
+        self.highCurrentInput.setChecked(self.highCurrent)
+        self.highCurrentInput.blockSignals(False)
 
     def setCurrent(self, amount=0):
         self.current = amount
         self.writeDAC(self.current)
-        self.highCurrentInput.setChecked(False)
         return
 
     def nudge(self, amount=1):
@@ -411,106 +1116,194 @@ class MyApp(QtWidgets.QWidget):
         self.writeDAC(self.current)
         return
 
+    def sweepingDevices(self):
+        return [device for device in self.devices.devices if device.sweep is not None]
+
     def sweep(self):
-        if (self.sweepEnabled):
-            if (self.current > 4096):
-                self.current += self.sweepStep*100
-            else:
-                self.current += self.sweepStep
-            if (self.current > self.sweepEnd):
-                self.stopSweep()
-                self.current = self.sweepEnd
-            self.writeDAC(self.current)
-            self.sweepProgressBar.setValue(self.current)
-        return
+        for device in self.sweepingDevices():
+            device.sweep.poll()
+        self.sweepProgress()
+
+    def sweepProgress(self):
+        # Shows how far the slowest board has come, finishes the sweeps that
+        # are done and wakes the rest up again at their next deadline. Sweeps
+        # also start by themselves when a capture with one is replayed.
+        sweeping = self.sweepingDevices()
+        for device in sweeping:
+            if (device not in self.sweepCurves):
+                self.sweepStarted(device)
+            if (not device.sweep.running):
+                self.finishSweep(device)
+        sweeping = self.sweepingDevices()
+        if (len(sweeping) == 0):
+            return
+        self.sweepProgressBar.setMaximum(max(device.sweep.end for device in sweeping))
+        self.sweepProgressBar.setValue(min(device.sweep.current for device in sweeping))
+        deadlines = [device.sweep.deadline for device in sweeping if device.sweep.deadline is not None]
+        if (len(deadlines) > 0):
+            self.sweepTimer.start(max(0, int(1000 * (min(deadlines) - time.monotonic()))))
+
+    def sweepStarted(self, device):
+        if (len(self.sweepCurves) == 0):
+            self.sweepNewWindowPending = self.sweepNewWindow.isChecked()
+            self.sweepSettleTimes = []
+            self.sweepName = self.sweepNameInput.text()
+            self.sweepProgressBar.setMinimum(device.sweep.start)
+            self.btnSweepStart.setEnabled(False)
+            self.btnSweepStop.setEnabled(True)
+        self.sweepCurves[device] = None
+
+    def finishSweep(self, device):
+        # The final curves are computed from all sweep points by a worker
+        # process and drawn by collectAnalyses() once they are ready
+        engine = device.finishSweep()
+        curve = self.sweepCurves.pop(device)
+        if (device is self.device):
+            self.current = engine.current
+            self.highCurrent = engine.highCurrent
+            self.showHighCurrent()
+        self.sweepSettleTimes.append(engine.settleSummary())
+        if (len(engine.points()[0]) > 0):
+            if (curve is None):
+                curve = self.createSweepCurve(device)
+            self.sweepAnalyses.append((self.plotwindow, curve, device, engine, self.devices.analyse(engine),
+                                       time.perf_counter()))
+            self.analysisTimer.start()
+        else:
+            showError("No elements", "No elements in plot", None)
+        if (len(self.sweepCurves) == 0):
+            self.btnSweepStop.setEnabled(False)
+            self.btnSweepStart.setEnabled(True)
+            self.sweepProgressBar.setValue(self.sweepProgressBar.maximum())
+            self.showSettleSummary(numpy.concatenate(self.sweepSettleTimes))
+
+    def collectAnalyses(self):
+        # Draws the final curves and stores the sweeps of live boards in the
+        # library. Replayed sweeps are in the library already.
+        pending = []
+        for analysis in self.sweepAnalyses:
+            window, curve, device, engine, future, started = analysis
+            if (not future.done()):
+                pending.append(analysis)
+                continue
+            self.devices.metrics.timing("sweep analysis", started)
+            try:
+                navg, nmax, nmin, fits = future.result()
+            except Exception as exc:
+                # A worker that died or failed, the other sweeps carry on
+                showError("Sweep analysis", "Analysing the sweep of " + device.name + " failed.", str(exc))
+                continue
+            curve.setData(navg['volts'], navg['current'])
+            window.addFits(curve, fits)
+            if (self.sweepMinMax.isChecked()):
+                window.addMinMax(curve, nmax, nmin)
+            if (self.library is not None and not device.replay):
+                try:
+                    self.library.add(self.sweepName, device.name, engine.settings(), engine.points(),
+                                     (navg, nmax, nmin), fits)
+                except (OSError, sqlite3.Error) as exc:
+                    showError("Sweep library", "Storing the sweep failed.", str(exc))
+                if (self.libraryDialog is not None and self.libraryDialog.isVisible()):
+                    self.libraryDialog.refresh()
+        self.sweepAnalyses = pending
+        if (len(pending) == 0):
+            self.analysisTimer.stop()
+
+    def showSettleSummary(self, times):
+        if (len(times) == 0):
+            self.settleSummaryLabel.setText("")
+            return
+        self.settleSummaryLabel.setText("Settled in {0:.0f} ms on average, {1} of {2} steps hit the maximum".format(
+            1000 * times['seconds'].mean(), numpy.count_nonzero(~times['settled']), len(times)))
 
     def startSweep(self):
-        self.sweepValuesVolts = []
-        self.sweepValuesCurrent = []
-        self.sweepValues = []
+        # Starts the same sweep on every open board
+        if (len(self.devices.devices) == 0 or self.replay is not None):
+            showError("Serial port not open.", "Please open serial port first.")
+            return
+        self.sweepMode = self.sweepModeInput.currentIndex()
 
         self.sweepStart = int(10 * float(self.sweepStartInput.text()))
         self.sweepEnd = int(10 * float(self.sweepEndInput.text()))
         self.sweepStep = int(10 * float(self.sweepStepInput.text()))
         self.sweepInterval = int(self.sweepTimeInput.text())
+        self.settleTolerance = float(self.settleToleranceInput.text())
+        self.settleSamples = int(self.settleSamplesInput.text())
         # TODO: Check the data makes sense before starting
-
-        self.current = self.sweepStart
-        self.writeDAC(self.current)
-        self.btnSweepStart.setEnabled(False)
-        self.btnSweepStop.setEnabled(True)
-        self.sweepProgressBar.setMinimum(self.sweepStart)
-        self.sweepProgressBar.setMaximum(self.sweepEnd)
-        self.sweepProgressBar.setValue(self.current)
-        self.sweepEnabled = True
-        self.sweepTimer.start(self.sweepInterval)
+        for device in self.devices.devices:
+            device.startSweep(self.sweepStart, self.sweepEnd, self.sweepStep, self.sweepInterval / 1000,
+                              self.sweepMode, self.settleTolerance / 1000, self.settleSamples)
+        self.highCurrent = self.device.highCurrent
+        self.showHighCurrent()
+        self.sweepProgress()
         return
 
-    def stopSweep(self):
-        self.sweepEnabled = False
-        self.sweepTimer.stop()
-        a = numpy.array(self.sweepValues, [('volts', float), ('current', float)])
-        a.sort(order=['current', 'volts'])
-
-        # TODO: Manual ranging and automatic ranging checkboxes
-        range = self.sweepEnd - self.sweepStart
-        # Ranges are 10% of the total range above and below.
-        # Range is in 100nV increments, so divide by 10.
-        range_low = (self.sweepStart - (range / 10)) / 10
-        range_high = (self.sweepEnd + (range / 10)) / 10
-
-        avg = []
-        maxes = []
-        mins = []
-
-        for i in numpy.unique(a['current']):
-            if (i < range_low or i > range_high):
-                continue
-            avg.append((i, numpy.average(a['volts'][(a['current'] == i)])))
-            maxes.append((i, numpy.max(a['volts'][(a['current'] == i)])))
-            mins.append((i, numpy.min(a['volts'][(a['current'] == i)])))
-
-        if (len(avg) == 0):
-            showError("No elements", "No elements in plot", None)
-            return
-
-        navg = numpy.array(avg, [('current', float), ('volts', float)])
-        nmax = numpy.array(maxes, [('current', float), ('volts', float)])
-        nmin = numpy.array(mins, [('current', float), ('volts', float)])
-
+    def createSweepCurve(self, device):
+        # Curves of boards sweeping together go in the same window, named after
+        # their port when there is more than one
         name = self.sweepNameInput.text()
+        if (len(self.devices.devices) > 1):
+            name = (name + " " + device.name).strip()
         if (name == ""):
             name = None
-        # TODO: Detect that the plotwindow is closed, and open a new one.
-        if (self.sweepNewWindow.isChecked() or not self.plotwindow != None):
+        newWindow = self.sweepNewWindowPending
+        self.sweepNewWindowPending = False
+        return self.addSweepCurve(name, newWindow)
+
+    def addSweepCurve(self, name, newWindow):
+        # A new curve in the newest sweep window, or in a new one if asked
+        # for or if that window has been closed
+        if (newWindow or self.plotwindow is None or self.plotwindow.closed):
+            self.sweepWindows = [window for window in self.sweepWindows if not window.closed]
             self.sweepPen = 1
-            self.plotwindow = pg.plot()
-            self.plotwindow.getPlotItem().setLabel('bottom', text='Voltage', units='V')
-            self.plotwindow.getPlotItem().setLabel('left', text='Current (µA)')
-            self.plotwindow.getPlotItem().setTitle('Sweep plot')
-            if (self.sweepNameInput.text() != ""):
-                self.plotwindow.getPlotItem().addLegend()
-            self.plotwindow.plot(navg['volts'], navg['current'], clear=1, pen=1, name=name)
+            self.plotwindow = SweepWindow()
+            self.sweepWindows.append(self.plotwindow)
         else:
             self.sweepPen += 1
-            if (self.sweepNameInput.text() != "" and self.plotwindow.getPlotItem().legend == None):
-                self.plotwindow.getPlotItem().addLegend()
-            self.plotwindow.plot(navg['volts'], navg['current'], pen=self.sweepPen, name=name)
-
-        if (self.sweepMinMax.isChecked()):
-            pmax = pg.PlotCurveItem(nmax['volts'],nmax['current'], pen=(196,196,196,128))
-            pmin = pg.PlotCurveItem(nmin['volts'], nmin['current'], pen=(196,196,196,128))
-            pfill = pg.FillBetweenItem(pmin, pmax, pg.mkBrush((128,128,128,128)),(128,0,0,128))
-
-            self.plotwindow.getPlotItem().addItem(pmax)
-            self.plotwindow.getPlotItem().addItem(pmin)
-            self.plotwindow.getPlotItem().addItem(pfill)
+        if (name is not None and self.plotwindow.getPlotItem().legend == None):
+            self.plotwindow.getPlotItem().addLegend()
+        return self.plotwindow.plot(pen=self.sweepPen, name=name)
+
+    def showLibrary(self):
+        if (self.libraryDialog is None):
+            self.libraryDialog = LibraryDialog(self.library, self.openLibrarySweeps)
+        self.libraryDialog.refresh()
+        self.libraryDialog.show()
+        self.libraryDialog.raise_()
+
+    def openLibrarySweeps(self, rows, newWindow):
+        # Stored curves come from the library's cache, only the model fits are
+        # redone, which takes well under a millisecond per curve
+        for row in rows:
+            try:
+                navg, nmax, nmin = self.library.curves(row['id'])
+            except (OSError, KeyError, ValueError) as exc:
+                showError("Sweep library", "Could not read sweep " + str(row['id']) + ".", str(exc))
+                continue
+            name = row['name'] or time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row['created']))
+            curve = self.addSweepCurve(name, newWindow)
+            newWindow = False
+            curve.setData(navg['volts'], navg['current'])
+            self.plotwindow.addFits(curve, fitCurve(navg['current'], navg['volts']))
+            if (self.sweepMinMax.isChecked()):
+                self.plotwindow.addMinMax(curve, nmax, nmin)
+
+    def renderSweep(self):
+        # Draws the average curves so far while sweeps are running
+        for device, curve in self.sweepCurves.items():
+            navg, nmax, nmin = device.sweep.curves()
+            if (len(navg) == 0):
+                continue
+            if (curve is None):
+                curve = self.sweepCurves[device] = self.createSweepCurve(device)
+            curve.setData(navg['volts'], navg['current'])
 
-        #a.sort(order=['volts', 'current'])
-        #plotwindow.plot(a['volts'], a['current'], pen=3)
-        self.btnSweepStop.setEnabled(False)
-        self.btnSweepStart.setEnabled(True)
-        self.sweepProgressBar.setValue(self.sweepEnd)
+    def stopSweep(self):
+        self.sweepTimer.stop()
+        for device in self.sweepingDevices():
+            if (device not in self.sweepCurves):
+                self.sweepStarted(device)
+            self.finishSweep(device)
         return
 
 
@@ -526,10 +1319,20 @@ def showError(errorheading, errortext, details=""):
     return msg.exec_()
 
 
-app = QtWidgets.QApplication([])
+def main():
+    app = QtWidgets.QApplication([])
+
+    w = MyApp()
+
+    w.show()
 
-w = MyApp()
+    result = app.exec_()
+    w.devices.shutdown()
+    if (w.library is not None):
+        w.library.close()
+    w.setMetricsLog(None)
+    sys.exit(result)
 
-w.show()
 
-sys.exit(app.exec_())
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
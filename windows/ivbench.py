@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy
+from ivcore import RingBuffer, DecimationPyramid, LineParser, FrameDecoder, checkSampling
+from ivengine import openDevice
+from ivsim import SimulatedDevice
+
+# Benchmarks for the acquisition path against the simulated device, so changes
+# to parsing, the reader or the plots can be checked without hardware.
+# Results are printed, can be saved as JSON and compared against a saved
+# baseline, exiting non-zero on a regression.
+
+# Whether a larger value is better, per metric name suffix
+higherIsBetter = ("samplesPerSecond",)
+
+
+def syntheticRaw(count, seed=0):
+    random = numpy.random.default_rng(seed)
+    return (random.integers(0, 4096, count), random.integers(0, 8192, count), random.integers(0, 8192, count),
+            random.integers(0, 2, count), random.integers(0, 2, count), random.integers(0, 256, count))
+
+
+def syntheticText(count):
+    lines = ["{0};{1};{2};{3};{4};{5}\r\n".format(*fields) for fields in zip(*syntheticRaw(count))]
+    return "".join(lines).encode('ascii')
+
+
+def syntheticFrames(count):
+    set, drop, current, highVoltage, highCurrent, ack = syntheticRaw(count)
+    bits = (set.astype(numpy.uint64) | (drop.astype(numpy.uint64) << numpy.uint64(12))
+            | (current.astype(numpy.uint64) << numpy.uint64(25))
+            | (highVoltage.astype(numpy.uint64) << numpy.uint64(38))
+            | (highCurrent.astype(numpy.uint64) << numpy.uint64(39)))
+    frames = numpy.zeros((count, FrameDecoder.frameSize), dtype=numpy.uint8)
+    frames[:, 0:2] = numpy.frombuffer(FrameDecoder.sync, dtype=numpy.uint8)
+    frames[:, 2] = numpy.arange(count) & 0xFF
+    for i in range(5):
+        frames[:, 3 + i] = (bits >> numpy.uint64(8 * i)) & numpy.uint64(0xFF)
+    frames[:, 8:10] = 0xFF
+    frames[:, 10] = ack
+    frames[:, 11] = frames[:, 2:11].sum(axis=1, dtype=numpy.uint8)
+    return frames.tobytes()
+
+
+def benchParse(count=100_000, chunkSize=4096):
+    # Parse time per sample, fed in chunks the size of a typical serial read
+    results = {}
+    for name, data, parser in (("text", syntheticText(count), LineParser()),
+                               ("binary", syntheticFrames(count), FrameDecoder())):
+        started = time.perf_counter()
+        parsed = 0
+        for i in range(0, len(data), chunkSize):
+            parsed += len(parser.feed(data[i:i + chunkSize]))
+        elapsed = time.perf_counter() - started
+        assert parsed == count, (name, parsed)
+        results["parse." + name + ".usPerSample"] = 1_000_000 * elapsed / count
+    return results
+
+
+# Baud rate of the simulated link, which limits text to 3333 samples/s, and
+# binary to the firmware's 5000
+benchSpeed = 1_000_000
+
+
+def openReader(device, binary, period):
+    return openDevice(device.port, benchSpeed, binary, period)
+
+
+def benchThroughput(binary, periods=(10000, 2000, 1000, 500, 300, 250, 200), seconds=2.0):
+    # Highest sample rate the host keeps up with, without lost or dropped
+    # samples, up to what the link carries
+    name = "binary" if binary else "text"
+    sustained = 0.0
+    for period in periods:
+        try:
+            checkSampling(benchSpeed, binary, period, 1)
+        except ValueError as exc:
+            print("  {0} at {1:.0f} samples/s: {2}".format(name, 1_000_000 / period, exc))
+            break
+        device = SimulatedDevice(period=period, seed=1, speed=benchSpeed)
+        device.start()
+        reader = openReader(device, binary, period)
+        time.sleep(0.3)
+        reader.get()
+        missed = reader.parser.missed + reader.droppedSamples
+        received = 0
+        started = time.monotonic()
+        while time.monotonic() - started < seconds:
+            time.sleep(0.1)
+            received += len(reader.get())
+        elapsed = time.monotonic() - started
+        missed = reader.parser.missed + reader.droppedSamples - missed + device.dropped
+        reader.stop()
+        device.stop()
+
+        rate = received / elapsed
+        expected = 1_000_000 / period
+        print("  {0} at {1:.0f} samples/s: received {2:.0f}/s, {3} lost".format(name, expected, rate, missed))
+        if (missed > 0 or rate < 0.95 * expected):
+            break
+        sustained = rate
+    return {"throughput." + name + ".samplesPerSecond": sustained}
+
+
+class FrameTimer:
+    # A live plot drawn from a decimation pyramid like the main window's, offscreen
+    def __init__(self):
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt5 import QtWidgets
+        import pyqtgraph as pg
+        self.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+        self.plot = pg.PlotWidget()
+        self.plot.resize(800, 400)
+        self.curve = self.plot.plot(pen=3)
+        self.plot.show()
+
+    def draw(self, history, low, high):
+        width = max(int(self.plot.getViewBox().width()), 100)
+        self.curve.setData(*history.view(low, high, width))
+        self.plot.grab()
+
+    def time(self, size, shown, frames=10):
+        # Frame time with `size` samples of history, `shown` of them visible,
+        # including adding a batch of new samples each frame
+        history = DecimationPyramid(RingBuffer(100_000))
+        batch = numpy.random.default_rng(0).normal(size=size)
+        history.buffer.extend(batch)
+        history.extend(batch)
+        self.plot.setXRange(size - shown, size, padding=0)
+        times = []
+        for i in range(frames):
+            started = time.perf_counter()
+            new = batch[:100]
+            history.buffer.extend(new)
+            history.extend(new)
+            total = history.count()
+            self.draw(history, total - shown, total)
+            times.append(time.perf_counter() - started)
+        return 1000 * numpy.median(times)
+
+
+def benchFrames(sizes=(1_000, 10_000, 100_000, 1_000_000)):
+    timer = FrameTimer()
+    results = {}
+    for size in sizes:
+        results["frame.{0}.newest256.ms".format(size)] = timer.time(size, min(size, 256))
+        results["frame.{0}.all.ms".format(size)] = timer.time(size, size)
+    return results
+
+
+def benchLatency(binary, frameTimer=None, repeats=20, period=1000):
+    # Time from queuing a DAC write until a sample taken at the new set value,
+    # by the device's acknowledgement, has arrived, and with a frame timer
+    # until it has gone into the history and a frame showing the newest
+    # 10 000 samples is drawn
+    device = SimulatedDevice(period=period, seed=2, speed=benchSpeed)
+    device.start()
+    reader = openReader(device, binary, period)
+    time.sleep(0.3)
+    history = DecimationPyramid(RingBuffer(10_000))
+    history.buffer.extend(numpy.zeros(10_000))
+    history.extend(numpy.zeros(10_000))
+    latencies = []
+    for i in range(repeats):
+        value = 100 + i
+        reader.get()
+        started = time.perf_counter()
+        live = reader.setpoint(value)
+        arrived = False
+        while not arrived and time.perf_counter() - started < 2:
+            time.sleep(0.0005)
+            samples = reader.get()
+            arrived = bool(numpy.any(samples['applied'] >= live))
+            if (frameTimer is not None):
+                # Into the plotted history like SampleStore.extend()
+                history.buffer.extend(samples['voltageDrop'])
+                history.extend(samples['voltageDrop'])
+        if (frameTimer is not None):
+            total = history.count()
+            frameTimer.draw(history, total - 10_000, total)
+        latencies.append(time.perf_counter() - started)
+    reader.stop()
+    device.stop()
+    name = "binary" if binary else "text"
+    target = "plotted" if frameTimer is not None else "received"
+    return {"latency.{0}.{1}.median.ms".format(name, target): 1000 * numpy.median(latencies),
+            "latency.{0}.{1}.p95.ms".format(name, target): 1000 * numpy.percentile(latencies, 95)}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, value in results.items():
+        if (name not in baseline):
+            continue
+        reference = baseline[name]
+        if (name.endswith(higherIsBetter)):
+            worse = value < reference * (1 - tolerance)
+        else:
+            worse = value > reference * (1 + tolerance)
+        if (worse):
+            regressions.append("{0}: {1:.4g}, baseline {2:.4g}".format(name, value, reference))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IV-grapher acquisition benchmarks against the simulated device")
+    parser.add_argument("--skip-gui", action="store_true", help="skip the plotting benchmarks")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    frameTimer = None
+    if (not args.skip_gui):
+        try:
+            frameTimer = FrameTimer()
+        except ImportError as exc:
+            print("Skipping plotting benchmarks: " + str(exc))
+
+    results = {}
+    print("Parsing")
+    results.update(benchParse())
+    print("Throughput")
+    results.update(benchThroughput(binary=False))
+    results.update(benchThroughput(binary=True))
+    print("Latency")
+    results.update(benchLatency(binary=False, frameTimer=frameTimer))
+    results.update(benchLatency(binary=True, frameTimer=frameTimer))
+    if (frameTimer is not None):
+        print("Frame time")
+        results.update(benchFrames())
+
+    for name, value in results.items():
+        print("{0:40} {1:12.4g}".format(name, value))
+    if (args.output):
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if (args.compare):
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression)
+        if (len(regressions) > 0):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
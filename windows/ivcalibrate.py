@@ -0,0 +1,154 @@
+import argparse
+import sys
+import numpy
+import serial
+from ivcore import defaultSamplePeriod, defaultCalibration, Calibration
+from ivengine import sweepFixed, highCurrentThreshold, openDevice, writeSetpoint, SweepEngine, run
+
+# Calibrates the current source and the current reading against a reference
+# resistor in place of the DUT, using the voltage reading as the reference.
+# Each current range is swept in fixed dwell steps, and polynomials are
+# fitted from the raw codes of every step to the current the resistor
+# actually carried. A single resistor cannot tell a gain error from the leak
+# through the amplifier input, so the leak is kept as it is.
+
+# Codes this close to full scale are taken as clipped
+saturatedCode = 8100
+
+
+class RawCollector:
+    # Recorder hook for the reader, keeps the raw codes of every sample with
+    # its applied count
+    def __init__(self):
+        self.raw = []
+        self.applied = []
+
+    def write(self, raw, samples):
+        self.raw.append(raw)
+        self.applied.append(samples['applied'])
+
+    def samples(self):
+        return numpy.concatenate(self.raw), numpy.concatenate(self.applied)
+
+
+def stepMeans(raw, applied, stepApplied, settled=0.5):
+    # Mean raw codes of each sweep step, over the part after the first
+    # `settled` fraction of its samples. Means rather than medians, as the
+    # noise resolves the codes to below one.
+    rows = []
+    for count in numpy.unique(stepApplied):
+        step = raw[applied == count]
+        step = step[int(len(step) * settled):]
+        if (len(step) == 0):
+            continue
+        rows.append((step['set'].mean(), step['drop'].mean(), step['current'].mean(), step['highVoltage'][0],
+                     step['highCurrent'][0]))
+    return numpy.array(rows, dtype=[('set', float), ('drop', float), ('current', float), ('highVoltage', int),
+                                    ('highCurrent', int)])
+
+
+def sweepRange(reader, highCurrent, resistance, maxVoltage, steps, dwell):
+    # Sweeps one current range up to what gives maxVoltage across the
+    # resistor, in the voltage range that fits it best. Returns the step means.
+    limit = int(10 * 1_000_000 * maxVoltage / resistance)
+    if (highCurrent):
+        start = highCurrentThreshold + 100
+        end = min(limit, 4095 * 100)
+        step = max(1, (end - start) // (100 * steps))
+    else:
+        start = 0
+        end = min(limit, highCurrentThreshold)
+        step = max(1, (end - start) // steps)
+    if (end <= start):
+        raise ValueError("The resistor is too large for the " + ("high" if highCurrent else "low")
+                         + " current range at " + str(maxVoltage) + " V")
+    reader.setVoltageRange(resistance * end / 10_000_000 > 8.0)
+
+    collector = RawCollector()
+    reader.recorder = collector
+    engine = SweepEngine(reader, start, end, step, dwell, sweepFixed)
+    try:
+        run(engine, timeout=10 * dwell * (steps + 2))
+    finally:
+        reader.recorder = None
+    writeSetpoint(reader, 0, engine.highCurrent)
+    raw, applied = collector.samples()
+    return stepMeans(raw, applied, engine.stepApplied)
+
+
+def fitRange(calibration, means, resistance, degree):
+    # New set and current polynomials from step means, as (set, current,
+    # residuals in μA)
+    means = means[(means['drop'] < saturatedCode) & (means['current'] < saturatedCode)]
+    if (len(means) <= degree):
+        raise ValueError("Too few unclipped steps to fit")
+    codes = numpy.arange(Calibration.codes)
+    volts = numpy.empty(len(means))
+    leak = numpy.empty(len(means))
+    for i, (highVoltage, highCurrent) in enumerate(zip(means['highVoltage'], means['highCurrent'])):
+        volts[i] = numpy.interp(means['drop'][i], codes, calibration.tables['drop'][highVoltage, highCurrent])
+        leak[i] = calibration.leak[highVoltage, highCurrent]
+    actual = 1_000_000 * volts / resistance
+    set = numpy.polynomial.polynomial.polyfit(means['set'], actual, degree)
+    current = numpy.polynomial.polynomial.polyfit(means['current'], actual + leak * volts, degree)
+    residuals = (numpy.polynomial.polynomial.polyval(means['set'], set) - actual,
+                 numpy.polynomial.polynomial.polyval(means['current'], current) - leak * volts - actual)
+    return set, current, residuals
+
+
+def calibrate(reader, resistance, calibration=defaultCalibration, currentRanges=(False, True), maxVoltage=7.5,
+              steps=40, dwell=0.2, degree=1, report=print):
+    # Returns a new calibration with the set and current channels of the
+    # given current ranges fitted, for both voltage ranges
+    ranges = {key: dict(range) for key, range in calibration.ranges.items()}
+    for highCurrent in currentRanges:
+        means = sweepRange(reader, highCurrent, resistance, maxVoltage, steps, dwell)
+        set, current, residuals = fitRange(calibration, means, resistance, degree)
+        for highVoltage in (0, 1):
+            ranges[(highVoltage, int(highCurrent))].update(set=list(set), current=list(current))
+        report("{0} current range: {1} steps, residual rms {2:.3f} μA set, {3:.3f} μA read".format(
+            "High" if highCurrent else "Low", len(means), numpy.sqrt(numpy.mean(residuals[0] ** 2)),
+            numpy.sqrt(numpy.mean(residuals[1] ** 2))))
+    return Calibration(ranges)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate an IV-grapher against a reference resistor")
+    parser.add_argument("port")
+    parser.add_argument("resistance", type=float, help="reference resistor in Ω")
+    parser.add_argument("output", help="calibration file to write")
+    parser.add_argument("--speed", type=int, default=14400)
+    parser.add_argument("--binary", action="store_true", help="use the binary sample protocol")
+    parser.add_argument("--period", type=float, default=defaultSamplePeriod / 1000, help="sample period in ms")
+    parser.add_argument("--calibration", help="calibration to start from, for the voltage reading and leak")
+    parser.add_argument("--ranges", choices=["low", "high", "both"], default="both", help="current ranges")
+    parser.add_argument("--max-voltage", type=float, default=7.5, help="highest voltage across the resistor")
+    parser.add_argument("--steps", type=int, default=40, help="steps per range")
+    parser.add_argument("--dwell", type=float, default=200, help="ms per step")
+    parser.add_argument("--degree", type=int, default=1, help="polynomial degree")
+    args = parser.parse_args()
+
+    calibration = defaultCalibration
+    if (args.calibration):
+        try:
+            calibration = Calibration.load(args.calibration)
+        except (OSError, ValueError, KeyError) as exc:
+            sys.exit("Reading " + args.calibration + " failed: " + str(exc))
+    currentRanges = {"low": (False,), "high": (True,), "both": (False, True)}[args.ranges]
+    try:
+        reader = openDevice(args.port, args.speed, args.binary, int(1000 * args.period), 1, calibration)
+    except (serial.SerialException, ValueError) as exc:
+        sys.exit("Opening " + args.port + " failed: " + str(exc))
+    try:
+        result = calibrate(reader, args.resistance, calibration, currentRanges, args.max_voltage, args.steps,
+                           args.dwell / 1000, args.degree)
+    except (serial.SerialException, OSError, ValueError) as exc:
+        sys.exit("Calibration failed: " + str(exc))
+    finally:
+        reader.stop()
+    result.save(args.output)
+    print("Written to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
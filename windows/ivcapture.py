@@ -0,0 +1,211 @@
+import json
+import os
+import queue
+import threading
+import time
+import numpy
+from ivcore import sampleType, defaultCalibration
+
+# Capture files hold everything the reader receives, for replay and offline
+# analysis. The file starts with a magic line and a JSON header padded to
+# headerSize bytes, followed by fixed size chunks. A chunk holds the number of
+# samples in it and then each column as chunkSamples values, so a column of a
+# whole capture is a strided view of a memory map and nothing is loaded
+# before it is used. Only the last chunk may be partly filled.
+magic = b"IVCAP1\n"
+headerSize = 4096
+defaultChunkSamples = 65536
+
+# Receive time in seconds since the epoch, the raw device values and the same
+# values scaled like sampleType. The header lists the columns of each file, so
+# captures from before a column was added can still be read.
+captureColumns = [('time', numpy.float64), ('set', numpy.uint16), ('drop', numpy.uint16),
+                  ('current', numpy.uint16), ('highVoltage', numpy.uint8), ('highCurrent', numpy.uint8),
+                  ('ack', numpy.uint8), ('step', numpy.int32), ('currentSet', numpy.float64),
+                  ('voltageDrop', numpy.float64), ('currentRead', numpy.float64), ('correctedCurrent', numpy.float64),
+                  ('oversampling', numpy.uint8), ('rate', numpy.float32), ('applied', numpy.int64)]
+rawColumns = ('set', 'drop', 'current', 'highVoltage', 'highCurrent', 'ack')
+
+
+def chunkType(chunkSamples, columns=captureColumns):
+    return numpy.dtype([('count', numpy.uint64)] + [(name, type, (chunkSamples,)) for name, type in columns])
+
+
+class CaptureWriter(threading.Thread):
+    # Appends samples to a capture file. write() only queues the batch, the
+    # chunks are filled and written by this thread. Every flushInterval seconds
+    # the new part of the chunk being filled is written in place, so a capture
+    # that is cut short loses at most that much. The header keeps the
+    # calibration the scaled columns were computed with.
+    def __init__(self, path, settings, calibration=defaultCalibration, chunkSamples=defaultChunkSamples,
+                 flushInterval=1.0):
+        super().__init__(daemon=True)
+        self.path = path
+        self.chunkSamples = chunkSamples
+        self.flushInterval = flushInterval
+        self.batches = queue.Queue()
+        self.chunk = numpy.zeros(1, chunkType(chunkSamples))
+        self.chunkStart = headerSize
+        self.flushed = 0
+        self.lastTime = 0.0
+
+        self.samplesWritten = 0
+        self.chunksWritten = 0
+
+        header = {'version': 2, 'created': time.time(), 'chunkSamples': chunkSamples,
+                  'columns': [(name, numpy.dtype(type).str) for name, type in captureColumns],
+                  'calibration': calibration.toJson(), 'settings': settings}
+        encoded = magic + json.dumps(header).encode('utf-8')
+        if (len(encoded) > headerSize):
+            raise ValueError("Capture header too large")
+        self.file = open(path, "wb")
+        self.file.write(encoded.ljust(headerSize, b"\0"))
+        self.file.truncate(headerSize + self.chunk.dtype.itemsize)
+
+    def write(self, raw, samples):
+        # Called from the reader thread. Samples are assumed to have arrived at
+        # the device rate, ending now, but never before the previous batch.
+        if (len(samples) == 0):
+            return
+        received = time.time() - (len(samples) - 1 - numpy.arange(len(samples))) / samples['rate']
+        received = numpy.maximum(received, self.lastTime)
+        self.lastTime = received[-1]
+        self.batches.put((received, raw, samples))
+
+    def stop(self):
+        self.batches.put(None)
+        self.join()
+
+    def run(self):
+        lastFlush = time.monotonic()
+        while True:
+            try:
+                batch = self.batches.get(timeout=self.flushInterval)
+            except queue.Empty:
+                batch = ()
+            if (batch is None):
+                break
+            if (len(batch) > 0):
+                self.append(*batch)
+            if (time.monotonic() - lastFlush >= self.flushInterval):
+                self.writeChunk()
+                lastFlush = time.monotonic()
+        self.writeChunk()
+        self.file.close()
+
+    def append(self, received, raw, samples):
+        while (len(samples) > 0):
+            count = int(self.chunk['count'][0])
+            n = min(self.chunkSamples - count, len(samples))
+            self.chunk['time'][0, count:count + n] = received[:n]
+            for name in rawColumns:
+                self.chunk[name][0, count:count + n] = raw[name][:n]
+            for name in sampleType.names:
+                self.chunk[name][0, count:count + n] = samples[name][:n]
+            self.chunk['count'] = count + n
+            self.samplesWritten += n
+            received, raw, samples = received[n:], raw[n:], samples[n:]
+            if (count + n == self.chunkSamples):
+                self.writeChunk()
+                self.chunk['count'] = 0
+                self.chunkStart += self.chunk.dtype.itemsize
+                self.flushed = 0
+                self.chunksWritten += 1
+                # The file always covers the chunk being filled, so readers
+                # see it while it grows
+                self.file.truncate(self.chunkStart + self.chunk.dtype.itemsize)
+
+    def writeChunk(self):
+        # Writes the values added since the last call, then the new count
+        count = int(self.chunk['count'][0])
+        if (count == self.flushed):
+            return
+        fields = self.chunk.dtype.fields
+        for name, type in captureColumns:
+            column = self.chunk[name][0]
+            self.file.seek(self.chunkStart + fields[name][1] + self.flushed * column.itemsize)
+            self.file.write(column[self.flushed:count].tobytes())
+        self.file.seek(self.chunkStart)
+        self.file.write(self.chunk['count'].tobytes())
+        self.file.flush()
+        self.flushed = count
+
+
+class CaptureFile:
+    # Read access to a capture through a memory map. Samples are addressed by
+    # their index in the capture, and only the chunks a request touches are read.
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            head = file.read(headerSize)
+        if (not head.startswith(magic)):
+            raise ValueError(path + " is not a capture file")
+        self.header = json.loads(head[len(magic):].rstrip(b"\0").decode('utf-8'))
+        self.chunkSamples = self.header['chunkSamples']
+        self.columnTypes = {name: numpy.dtype(type) for name, type in self.header['columns']}
+        type = chunkType(self.chunkSamples, self.columnTypes.items())
+        # A capture still being written can end in the middle of a chunk
+        chunks = (os.path.getsize(path) - headerSize) // type.itemsize
+        self.chunks = numpy.memmap(path, type, mode='r', offset=headerSize, shape=(chunks,))
+        self.length = 0 if chunks == 0 else (chunks - 1) * self.chunkSamples + int(self.chunks['count'][-1])
+
+    def __len__(self):
+        return self.length
+
+    def columns(self, names, start, stop):
+        # The named columns for samples start to stop, copied out of the map.
+        # Columns the file does not have are zero.
+        stop = min(stop, self.length)
+        start = min(start, stop)
+        result = {name: numpy.zeros(stop - start, dict(captureColumns)[name]) for name in names}
+        stored = [name for name in names if name in self.columnTypes]
+        position = start
+        while (position < stop):
+            index, offset = divmod(position, self.chunkSamples)
+            n = min(self.chunkSamples - offset, stop - position)
+            chunk = self.chunks[index]
+            for name in stored:
+                result[name][position - start:position - start + n] = chunk[name][offset:offset + n]
+            position += n
+        return result
+
+    def samples(self, start, stop):
+        # Scaled samples in the form the reader hands out
+        names = [name for name in sampleType.names]
+        columns = self.columns(names, start, stop)
+        samples = numpy.empty(len(columns['step']), sampleType)
+        for name in names:
+            samples[name] = columns[name]
+        return samples
+
+    def times(self, start, stop):
+        return self.columns(['time'], start, stop)['time']
+
+    def firstTime(self):
+        return float(self.chunks[0]['time'][0]) if self.length > 0 else 0.0
+
+
+class CaptureReplay:
+    # Hands out a capture's samples through get() like a SerialReader would,
+    # paced by the recorded times multiplied by `speed`, at most maxBatch per
+    # call so a fast replay cannot stall the GUI.
+    def __init__(self, path, speed=1.0, maxBatch=100_000):
+        self.capture = CaptureFile(path)
+        self.speed = speed
+        self.maxBatch = maxBatch
+        self.position = 0
+        self.error = None
+        self.droppedSamples = 0
+        self.started = time.monotonic()
+        self.startTime = self.capture.firstTime()
+
+    def finished(self):
+        return self.position >= len(self.capture)
+
+    def get(self):
+        due = self.startTime + (time.monotonic() - self.started) * self.speed
+        stop = min(self.position + self.maxBatch, len(self.capture))
+        times = self.capture.times(self.position, stop)
+        stop = self.position + int(numpy.searchsorted(times, due, side='right'))
+        samples = self.capture.samples(self.position, stop)
+        self.position = stop
+        return samples
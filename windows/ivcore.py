@@ -0,0 +1,1026 @@
+import numpy
+import serial
+import serial.tools.list_ports
+import re
+import json
+import threading
+import queue
+import collections
+import time
+from ivmetrics import Metrics
+
+# One line from the device, as sent: set current;voltage drop;actual current;high/low voltage;high/low current;
+# applied setpoint counter and the step index of a running sweep program, -1 when none runs
+rawSampleType = numpy.dtype([('set', numpy.int32), ('drop', numpy.int32), ('current', numpy.int32),
+                             ('highVoltage', numpy.int32), ('highCurrent', numpy.int32), ('step', numpy.int32),
+                             ('ack', numpy.int32)])
+
+# The same sample scaled to μA and V, with the device's sampling settings at the time:
+# conversions averaged per sample and samples per second. applied is the number of
+# output commands from this host the device had applied, see SerialReader. set is
+# the DAC code as sent, see setTenths().
+sampleType = numpy.dtype([('currentSet', float), ('voltageDrop', float), ('currentRead', float),
+                          ('correctedCurrent', float), ('highVoltage', numpy.int8), ('highCurrent', numpy.int8),
+                          ('step', numpy.int32), ('oversampling', numpy.uint8), ('rate', numpy.float32),
+                          ('applied', numpy.int64), ('set', numpy.uint16)])
+
+# Device default sampling period in μs, matching the original free running Timer1 overflow
+defaultSamplePeriod = 32768
+
+
+class RingBuffer:
+    # Fixed capacity float64 ring buffer. Every value is stored twice, at
+    # index i and i+size, so the newest `size` values are always available
+    # as one contiguous slice and get() never has to copy or unroll.
+    def __init__(self, size):
+        self.size = size
+        self.data = numpy.zeros(2 * size)
+        self.index = 0
+        self.count = 0
+
+    def append(self, x):
+        self.data[self.index] = x
+        self.data[self.index + self.size] = x
+        self.index = (self.index + 1) % self.size
+        self.count += 1
+
+    def extend(self, values):
+        values = numpy.asarray(values, dtype=float)
+        n = len(values)
+        if (n == 0):
+            return
+        self.count += n
+        if (n >= self.size):
+            # Only the newest values survive, lay them out from scratch
+            values = values[-self.size:]
+            self.data[:self.size] = values
+            self.data[self.size:] = values
+            self.index = 0
+            return
+        end = self.index + n
+        if (end <= self.size):
+            self.data[self.index:end] = values
+            self.data[self.index + self.size:end + self.size] = values
+        else:
+            split = self.size - self.index
+            self.data[self.index:self.size] = values[:split]
+            self.data[self.index + self.size:] = values[:split]
+            self.data[:end - self.size] = values[split:]
+            self.data[self.size:end] = values[split:]
+        self.index = end % self.size
+
+    def get(self):
+        # Oldest to newest, as a view into the buffer. Valid until the next append.
+        return self.data[self.index:self.index + self.size]
+
+
+class DecimationPyramid:
+    # Minimum, maximum and mean of blocks of 2, 4, 8, ... samples of whatever
+    # goes into `buffer`, kept up to date as samples arrive. Every level holds
+    # its newest `capacity` blocks, so the coarse levels reach back far beyond
+    # the raw buffer, and any stretch of history can be drawn from about as
+    # many points as the plot is pixels wide. Samples are addressed by their
+    # absolute index, counting from the first sample ever added.
+    def __init__(self, buffer, capacity=65536):
+        self.buffer = buffer
+        self.capacity = capacity
+        # Level i summarises blocks of 2**(i + 1) samples as (mins, maxes, means)
+        self.levels = []
+        # Per level, the (min, max, mean) of a block still waiting for its pair
+        self.carries = []
+
+    def count(self):
+        return self.buffer.count
+
+    def extend(self, values):
+        # Call after the same values went into the buffer
+        mins = maxes = means = numpy.asarray(values, dtype=float)
+        level = 0
+        while (len(mins) > 0):
+            if (level == len(self.levels)):
+                self.levels.append(tuple(RingBuffer(self.capacity) for i in range(3)))
+                self.carries.append(None)
+            carry = self.carries[level]
+            if (carry is not None):
+                mins = numpy.concatenate(([carry[0]], mins))
+                maxes = numpy.concatenate(([carry[1]], maxes))
+                means = numpy.concatenate(([carry[2]], means))
+            if (len(mins) % 2 == 1):
+                self.carries[level] = (mins[-1], maxes[-1], means[-1])
+                mins, maxes, means = mins[:-1], maxes[:-1], means[:-1]
+            else:
+                self.carries[level] = None
+            mins = numpy.minimum(mins[0::2], mins[1::2])
+            maxes = numpy.maximum(maxes[0::2], maxes[1::2])
+            means = (means[0::2] + means[1::2]) / 2
+            for summary, new in zip(self.levels[level], (mins, maxes, means)):
+                summary.extend(new)
+            level += 1
+
+    def view(self, start, stop, width, mode='peak'):
+        # x, y for samples start to stop at the finest level that needs at most
+        # `width` blocks and still reaches back to start. In 'peak' mode every
+        # block becomes its minimum and maximum, so short spikes stay visible;
+        # in 'mean' mode its mean.
+        total = self.count()
+        start = max(int(start), 0)
+        stop = min(int(stop), total)
+        if (stop <= start):
+            return numpy.empty(0), numpy.empty(0)
+        span = stop - start
+        if (span <= width and start >= total - min(total, self.buffer.size)):
+            values = self.buffer.get()[self.buffer.size - (total - start):self.buffer.size - (total - stop)]
+            return numpy.arange(start, stop), values
+
+        for level, (mins, maxes, means) in enumerate(self.levels):
+            blockSize = 2 ** (level + 1)
+            blocks = mins.count
+            oldest = blocks - min(blocks, self.capacity)
+            if (span / blockSize <= width and start // blockSize >= oldest) or level == len(self.levels) - 1:
+                break
+        last = min((stop - 1) // blockSize + 1, blocks)
+        first = min(max(start // blockSize, oldest), last)
+        window = slice(self.capacity - (blocks - first), self.capacity - (blocks - last))
+        centres = (numpy.arange(first, last) + 0.5) * blockSize
+        blockMins, blockMaxes, blockMeans = mins.get()[window], maxes.get()[window], means.get()[window]
+        # The newest samples are in no complete block yet
+        if (stop > blocks * blockSize):
+            pending = self.pending(level)
+            if (pending is not None):
+                low, high, mean, count = pending
+                centres = numpy.append(centres, blocks * blockSize + count / 2)
+                blockMins = numpy.append(blockMins, low)
+                blockMaxes = numpy.append(blockMaxes, high)
+                blockMeans = numpy.append(blockMeans, mean)
+        if (mode == 'mean'):
+            return centres, blockMeans
+        y = numpy.empty(2 * len(centres))
+        y[0::2] = blockMins
+        y[1::2] = blockMaxes
+        return numpy.repeat(centres, 2), y
+
+    def pending(self, level):
+        # (min, max, mean, count) of the samples after the last complete block
+        # of `level`, which wait in the carries of it and the levels below, or
+        # None when there are none
+        carries = [(carry, 2 ** i) for i, carry in enumerate(self.carries[:level + 1]) if carry is not None]
+        if (len(carries) == 0):
+            return None
+        count = sum(size for carry, size in carries)
+        return (min(carry[0] for carry, size in carries), max(carry[1] for carry, size in carries),
+                sum(carry[2] * size for carry, size in carries) / count, count)
+
+
+class RunningStats:
+    # Count, mean, standard deviation, minimum and maximum over the values held
+    # in a RingBuffer, updated as values go in and out of the window instead of
+    # being recomputed over the whole buffer.
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.count = 0
+        self.sum = 0.0
+        self.sumSquares = 0.0
+        self.sinceExact = 0
+        # Candidates for the window minimum and maximum as (index, value), with
+        # values increasing (mins) or decreasing (maxes) from front to back
+        self.mins = collections.deque()
+        self.maxes = collections.deque()
+
+    def extend(self, values):
+        values = numpy.asarray(values, dtype=float)
+        n = len(values)
+        if (n == 0):
+            return
+        size = self.buffer.size
+        allValues = values
+        if (n > size):
+            values = values[-size:]
+        evicted = max(0, self.count + len(values) - size)
+        if (evicted > 0):
+            oldest = self.buffer.get()[size - self.count:size - self.count + evicted]
+            self.sum -= oldest.sum()
+            self.sumSquares -= numpy.dot(oldest, oldest)
+        self.sum += values.sum()
+        self.sumSquares += numpy.dot(values, values)
+        self.count = min(self.count + len(values), size)
+        # The buffer gets every value, so its count stays the number of values seen
+        self.buffer.extend(allValues)
+
+        # Subtracting old values slowly loses precision, so start over from the
+        # window contents once per window length. Amortised that is O(1).
+        self.sinceExact += len(values)
+        if (self.sinceExact >= size):
+            window = self.buffer.get()[size - self.count:]
+            self.sum = window.sum()
+            self.sumSquares = numpy.dot(window, window)
+            self.sinceExact = 0
+
+        first = self.buffer.count - len(values)
+        self.updateMinimum(self.mins, values, first)
+        # The maximum is the minimum of the negated values
+        self.updateMinimum(self.maxes, -values, first)
+
+    def updateMinimum(self, candidates, values, first):
+        # Only values below everything after them in the batch can ever become
+        # the minimum of a later window
+        suffix = numpy.minimum.accumulate(values[::-1])[::-1]
+        keep = numpy.ones(len(values), dtype=bool)
+        keep[:-1] = values[:-1] < suffix[1:]
+        indices = numpy.flatnonzero(keep)
+        while (len(candidates) > 0 and candidates[-1][1] >= suffix[0]):
+            candidates.pop()
+        candidates.extend(zip((indices + first).tolist(), values[indices].tolist()))
+        oldest = self.buffer.count - self.count
+        while (candidates[0][0] < oldest):
+            candidates.popleft()
+
+    def mean(self):
+        if (self.count == 0):
+            return numpy.nan
+        return self.sum / self.count
+
+    def std(self):
+        if (self.count == 0):
+            return numpy.nan
+        mean = self.sum / self.count
+        return numpy.sqrt(max(self.sumSquares / self.count - mean * mean, 0.0))
+
+    def rms(self):
+        if (self.count == 0):
+            return numpy.nan
+        return numpy.sqrt(max(self.sumSquares / self.count, 0.0))
+
+    def min(self):
+        if (self.count == 0):
+            return numpy.nan
+        return self.mins[0][1]
+
+    def max(self):
+        if (self.count == 0):
+            return numpy.nan
+        return -self.maxes[0][1]
+
+
+class LiveStatistics:
+    # Everything the readouts show: the newest sample, the values derived from
+    # it and running statistics over the drop voltage and current error.
+    def __init__(self, size):
+        self.drop = RunningStats(RingBuffer(size))
+        self.currentError = RunningStats(RingBuffer(size))
+        self.latest = None
+
+    def extend(self, samples):
+        if (len(samples) == 0):
+            return
+        self.drop.extend(samples['voltageDrop'])
+        self.currentError.extend(samples['currentRead'] - samples['currentSet'])
+        self.latest = samples[-1]
+
+    def correctedCurrent(self):
+        return self.latest['correctedCurrent']
+
+    def resistance(self):
+        # Equivalent resistance in Ω, infinite when no current flows
+        if (self.latest['currentRead'] == 0):
+            return numpy.inf
+        return self.latest['voltageDrop'] / (self.latest['currentRead'] / 1_000_000)
+
+
+class SettleDetector:
+    # Decides when the drop voltage at a sweep step has settled: over the last
+    # `window` samples both the standard deviation and the drift of a fitted
+    # line across the window are within `tolerance` volts.
+    def __init__(self, window, tolerance):
+        self.window = window
+        self.tolerance = tolerance
+        # Least squares slope of y against sample index is dot(x, y) / dot(x, x)
+        # with x centred on zero
+        self.x = numpy.arange(window) - (window - 1) / 2
+        self.xx = numpy.dot(self.x, self.x)
+        self.reset()
+
+    def reset(self):
+        self.buffer = RingBuffer(self.window)
+        self.started = time.monotonic()
+
+    def extend(self, volts):
+        self.buffer.extend(volts)
+        if (self.buffer.count < self.window):
+            return False
+        values = self.buffer.get()
+        if (values.std() > self.tolerance):
+            return False
+        if (self.window > 1 and abs(numpy.dot(self.x, values) / self.xx) * self.window > self.tolerance):
+            return False
+        return True
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+
+# Time from a sweep step being set until it settled or hit the maximum dwell
+settleTimeType = numpy.dtype([('current', float), ('seconds', float), ('settled', bool)])
+
+
+# A point on an aggregated sweep curve
+curvePointType = numpy.dtype([('current', float), ('volts', float)])
+
+
+class SweepAggregator:
+    # Count, sum, sum of squares, minimum and maximum of the drop voltage for
+    # every current seen during a sweep, updated as samples arrive so the curve
+    # is ready at any time. Corrected currents come in 0.1μA steps, so the
+    # step in tenths of μA indexes the arrays directly.
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = numpy.zeros(0, dtype=numpy.int64)
+        self.sum = numpy.zeros(0)
+        self.sumSquares = numpy.zeros(0)
+        self.min = numpy.zeros(0)
+        self.max = numpy.zeros(0)
+
+    def grow(self, size):
+        if (size <= len(self.count)):
+            return
+        # Grow geometrically so a sweep only reallocates a handful of times
+        size = max(size, 2 * len(self.count))
+        extra = size - len(self.count)
+        self.count = numpy.concatenate((self.count, numpy.zeros(extra, dtype=numpy.int64)))
+        self.sum = numpy.concatenate((self.sum, numpy.zeros(extra)))
+        self.sumSquares = numpy.concatenate((self.sumSquares, numpy.zeros(extra)))
+        self.min = numpy.concatenate((self.min, numpy.full(extra, numpy.inf)))
+        self.max = numpy.concatenate((self.max, numpy.full(extra, -numpy.inf)))
+
+    def extend(self, volts, current):
+        if (len(volts) == 0):
+            return
+        sampleSteps = numpy.rint(numpy.asarray(current) * 10).astype(numpy.intp)
+        steps, inverse = numpy.unique(sampleSteps, return_inverse=True)
+        self.grow(steps[-1] + 1)
+        self.count[steps] += numpy.bincount(inverse)
+        self.sum[steps] += numpy.bincount(inverse, volts)
+        self.sumSquares[steps] += numpy.bincount(inverse, numpy.square(volts))
+        numpy.minimum.at(self.min, sampleSteps, volts)
+        numpy.maximum.at(self.max, sampleSteps, volts)
+
+    def curves(self, low=-numpy.inf, high=numpy.inf):
+        # Average, maximum and minimum voltage per current within [low, high] μA
+        steps = numpy.flatnonzero(self.count)
+        current = steps / 10
+        keep = (current >= low) & (current <= high)
+        steps = steps[keep]
+        current = current[keep]
+        navg = numpy.empty(len(steps), curvePointType)
+        nmax = numpy.empty(len(steps), curvePointType)
+        nmin = numpy.empty(len(steps), curvePointType)
+        navg['current'] = nmax['current'] = nmin['current'] = current
+        navg['volts'] = self.sum[steps] / self.count[steps]
+        nmax['volts'] = self.max[steps]
+        nmin['volts'] = self.min[steps]
+        return navg, nmax, nmin
+
+
+def aggregateSweep(volts, current):
+    # The same curves as SweepAggregator.curves(), computed in one go from raw
+    # sweep points, e.g. from a stored capture
+    volts = numpy.asarray(volts, dtype=float)
+    current = numpy.asarray(current, dtype=float)
+    if (len(volts) == 0):
+        return tuple(numpy.empty(0, curvePointType) for i in range(3))
+    current, inverse, count = numpy.unique(current, return_inverse=True, return_counts=True)
+    # Sorting by step puts each step's voltages next to each other for reduceat
+    sortedVolts = volts[numpy.argsort(inverse, kind='stable')]
+    starts = numpy.concatenate(([0], numpy.cumsum(count)[:-1]))
+    navg = numpy.empty(len(current), curvePointType)
+    nmax = numpy.empty(len(current), curvePointType)
+    nmin = numpy.empty(len(current), curvePointType)
+    navg['current'] = nmax['current'] = nmin['current'] = current
+    navg['volts'] = numpy.bincount(inverse, volts) / count
+    nmax['volts'] = numpy.maximum.reduceat(sortedVolts, starts)
+    nmin['volts'] = numpy.minimum.reduceat(sortedVolts, starts)
+    return navg, nmax, nmin
+
+
+class LineParser:
+    # Turns blocks of bytes from the device into rawSampleType arrays. A trailing
+    # partial line is kept for the next block. Lines that do not match the
+    # protocol are counted and skipped. The sweep step field is only sent while
+    # a sweep program runs, so lines have either six or seven fields. Fields
+    # longer than five digits do not come from the device and would overflow.
+    linePattern = re.compile(rb"^\d{1,5};\d{1,5};\d{1,5};[01];[01];\d{1,5}(?:;\d{1,5})?(?=\r?$)", re.MULTILINE)
+    maxLineLength = 64
+
+    def __init__(self):
+        self.partial = b""
+        self.malformed = 0
+        # Text lines carry no sequence number, so lost lines cannot be counted
+        self.missed = 0
+
+    def feed(self, data):
+        data = self.partial + data
+        end = data.rfind(b"\n") + 1
+        self.partial = data[end:]
+        if (len(self.partial) > self.maxLineLength):
+            # No line ending in sight, this is not our protocol
+            self.partial = b""
+            self.malformed += 1
+
+        lines = self.linePattern.findall(data, 0, end)
+        self.malformed += data.count(b"\n", 0, end) - len(lines)
+        if (len(lines) == 0):
+            return numpy.empty(0, rawSampleType)
+        values = numpy.fromstring(b";".join(lines), dtype=numpy.int32, sep=";")
+
+        raw = numpy.empty(len(lines), rawSampleType)
+        if (len(values) == 6 * len(lines)):
+            fields = values.reshape(-1, 6)
+            raw['step'] = -1
+        elif (len(values) == 7 * len(lines)):
+            fields = values.reshape(-1, 7)
+            raw['step'] = fields[:, 6]
+        else:
+            # A sweep program started or ended within this block
+            counts = numpy.fromiter((line.count(b";") + 1 for line in lines), numpy.intp, len(lines))
+            starts = numpy.cumsum(counts) - counts
+            fields = values[starts[:, numpy.newaxis] + numpy.arange(6)]
+            raw['step'] = numpy.where(counts == 7, values[numpy.minimum(starts + 6, len(values) - 1)], -1)
+        raw['set'] = fields[:, 0]
+        raw['drop'] = fields[:, 1]
+        raw['current'] = fields[:, 2]
+        raw['highVoltage'] = fields[:, 3]
+        raw['highCurrent'] = fields[:, 4]
+        raw['ack'] = fields[:, 5]
+        return raw
+
+
+class FrameDecoder:
+    # Decodes the device's binary frames into rawSampleType arrays, see
+    # sendBinary() in the sketch for the layout. Frames are checked and unpacked
+    # as rows of a (n, frameSize) view straight onto the received bytes. After a
+    # broken frame the decoder searches for the next valid one. Gaps in the
+    # sequence counter are counted as missed frames.
+    sync = b"\xa5\x5a"
+    frameSize = 12
+    noStep = 0xFFFF
+
+    def __init__(self):
+        self.partial = b""
+        self.malformed = 0
+        self.missed = 0
+        self.skippedBytes = 0
+        self.sequence = None
+
+    def valid(self, frames):
+        checksum = frames[:, 2:11].sum(axis=1, dtype=numpy.uint8)
+        return (frames[:, 0] == self.sync[0]) & (frames[:, 1] == self.sync[1]) & (checksum == frames[:, 11])
+
+    def findFrame(self, data, buffer, position):
+        # Returns where the next valid frame starts, or where to keep the
+        # remaining bytes from if no complete one is left
+        while True:
+            start = data.find(self.sync, position)
+            if (start < 0):
+                if (data.endswith(self.sync[:1])):
+                    return len(data) - 1, False
+                return len(data), False
+            if (start + self.frameSize > len(data)):
+                return start, False
+            if (self.valid(buffer[start:start + self.frameSize].reshape(1, self.frameSize))[0]):
+                return start, True
+            position = start + 1
+
+    def feed(self, data):
+        data = self.partial + data
+        buffer = numpy.frombuffer(data, dtype=numpy.uint8)
+        blocks = []
+        position = 0
+        while True:
+            start, found = self.findFrame(data, buffer, position)
+            self.skippedBytes += start - position
+            position = start
+            if (not found):
+                break
+            count = (len(data) - start) // self.frameSize
+            frames = buffer[start:start + count * self.frameSize].reshape(count, self.frameSize)
+            valid = self.valid(frames)
+            good = count if valid.all() else int(numpy.argmin(valid))
+            blocks.append(frames[:good])
+            position = start + good * self.frameSize
+            if (good == count):
+                break
+            self.malformed += 1
+        self.partial = data[position:]
+
+        if (len(blocks) == 0):
+            return numpy.empty(0, rawSampleType)
+        return self.unpack(numpy.concatenate(blocks))
+
+    def unpack(self, frames):
+        sequence = frames[:, 2]
+        if (self.sequence is not None):
+            sequence = numpy.concatenate(([self.sequence], sequence))
+        self.missed += int(((numpy.diff(sequence) - 1) & 0xFF).sum())
+        self.sequence = sequence[-1]
+
+        bits = numpy.zeros(len(frames), dtype=numpy.uint64)
+        for i in range(5):
+            bits |= frames[:, 3 + i].astype(numpy.uint64) << numpy.uint64(8 * i)
+        raw = numpy.empty(len(frames), rawSampleType)
+        raw['set'] = bits & 0x0FFF
+        raw['drop'] = (bits >> numpy.uint64(12)) & 0x1FFF
+        raw['current'] = (bits >> numpy.uint64(25)) & 0x1FFF
+        raw['highVoltage'] = (bits >> numpy.uint64(38)) & 1
+        raw['highCurrent'] = (bits >> numpy.uint64(39)) & 1
+        step = frames[:, 8].astype(numpy.int32) | (frames[:, 9].astype(numpy.int32) << 8)
+        raw['step'] = numpy.where(step == self.noStep, -1, step)
+        raw['ack'] = frames[:, 10]
+        return raw
+
+
+class Calibration:
+    # Turns raw codes into μA and V. Every combination of voltage and current
+    # range has a polynomial per channel in the raw code, lowest order first,
+    # and a leak in μA per volt through the differential amplifier input. The
+    # polynomials are evaluated for every code up front, so scaling a batch is
+    # one table index per channel.
+    codes = 8192
+    channels = ('set', 'drop', 'current')
+
+    def __init__(self, ranges=None):
+        # ranges maps (highVoltage, highCurrent) to a dict of coefficients per
+        # channel and 'leak'. The default is the plain scaling by range.
+        self.ranges = ranges if ranges is not None else defaultCalibrationRanges()
+        codes = numpy.arange(self.codes)
+        self.tables = {channel: numpy.empty((2, 2, self.codes)) for channel in self.channels}
+        self.leak = numpy.empty((2, 2))
+        for (highVoltage, highCurrent), range in self.ranges.items():
+            for channel in self.channels:
+                self.tables[channel][highVoltage, highCurrent] = numpy.polynomial.polynomial.polyval(
+                    codes, range[channel])
+            self.leak[highVoltage, highCurrent] = range['leak']
+
+    def toJson(self):
+        return {'version': 1, 'ranges': [dict(highVoltage=highVoltage, highCurrent=highCurrent,
+                                               **{name: list(value) if name in self.channels else value
+                                                  for name, value in range.items()})
+                                          for (highVoltage, highCurrent), range in sorted(self.ranges.items())]}
+
+    @classmethod
+    def fromJson(cls, data):
+        ranges = defaultCalibrationRanges()
+        for range in data['ranges']:
+            key = (int(range['highVoltage']), int(range['highCurrent']))
+            ranges[key] = {name: range.get(name, ranges[key][name]) for name in cls.channels + ('leak',)}
+        return cls(ranges)
+
+    @classmethod
+    def load(cls, path):
+        # Raises OSError, or ValueError or KeyError for a broken file
+        with open(path) as file:
+            return cls.fromJson(json.load(file))
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(self.toJson(), file, indent=2)
+
+    def scale(self, raw, samples):
+        # Indexes into the flattened tables. Text lines may carry numbers out
+        # of range, frames cannot.
+        range = 2 * raw['highVoltage'] + raw['highCurrent']
+        offset = self.codes * range
+        last = self.codes - 1
+        samples['currentSet'] = self.tables['set'].ravel().take(offset + numpy.clip(raw['set'], 0, last))
+        samples['voltageDrop'] = self.tables['drop'].ravel().take(offset + numpy.clip(raw['drop'], 0, last))
+        samples['currentRead'] = self.tables['current'].ravel().take(offset + numpy.clip(raw['current'], 0, last))
+        # Rounded before truncating, so a whole number of tenths does not
+        # come out a tenth lower through floating point error
+        corrected = 10 * (samples['currentRead'] - self.leak.ravel().take(range) * samples['voltageDrop'])
+        samples['correctedCurrent'] = numpy.maximum(numpy.trunc(numpy.round(corrected, 6)) / 10, 0.0)
+
+
+def defaultCalibrationRanges():
+    # Codes are tenths of μA and mV, times 100 in the high current range and
+    # 10 in the high voltage range, and the device leaks about 1μA per volt
+    ranges = {}
+    for highVoltage in (0, 1):
+        for highCurrent in (0, 1):
+            currentScale = 100 if highCurrent else 1
+            voltageScale = 10 if highVoltage else 1
+            ranges[(highVoltage, highCurrent)] = {'set': [0.0, currentScale / 10], 'drop': [0.0, voltageScale / 1000],
+                                                  'current': [0.0, currentScale / 10], 'leak': 1.0}
+    return ranges
+
+
+defaultCalibration = Calibration()
+
+
+def scaleSamples(raw, calibration=defaultCalibration):
+    samples = numpy.empty(len(raw), sampleType)
+    calibration.scale(raw, samples)
+    samples['highVoltage'] = raw['highVoltage']
+    samples['highCurrent'] = raw['highCurrent']
+    samples['step'] = raw['step']
+    samples['set'] = raw['set']
+    # Counted from the device's own counter until a reader relates it to its commands
+    samples['applied'] = raw['ack']
+    return samples
+
+
+def setTenths(samples):
+    # The output the host set, in tenths of μA, for a sample or an array of
+    # them. From the DAC code rather than currentSet, which a calibration
+    # moves off the whole numbers the host sent.
+    return samples['set'].astype(numpy.int64) * numpy.where(samples['highCurrent'], 100, 1)
+
+
+# The board's answer to 'I': firmware version and the protocol features it has
+identityPattern = re.compile(rb"IV-grapher;([^;\r\n]*);([^\r\n]*)\r\n")
+# Seconds a board has to answer, which covers the reset opening the port
+# causes. Until it has sent something or bootTime has passed, it may still be
+# in its bootloader, which must not get any bytes.
+probeTimeout = 3.0
+bootTime = 2.0
+askInterval = 0.25
+
+
+def identify(port, timeout=probeTimeout):
+    # Asks the board on an open port who it is. A running board answers within
+    # milliseconds. Returns its version and capabilities, raises
+    # serial.SerialException if nothing answers in time.
+    started = time.monotonic()
+    asked = None
+    received = b""
+    while time.monotonic() - started < timeout:
+        received = received[-256:] + port.read(max(1, port.in_waiting))
+        match = identityPattern.search(received)
+        if (match):
+            return {'version': match.group(1).decode('ascii', 'replace'),
+                    'capabilities': set(match.group(2).decode('ascii', 'replace').split(","))}
+        now = time.monotonic()
+        if ((len(received) > 0 or now - started >= bootTime) and (asked is None or now - asked >= askInterval)):
+            port.write(b"I")
+            asked = now
+    raise serial.SerialException("No IV-grapher answered on " + str(port.port))
+
+
+def connectPort(portName, speed, timeout=probeTimeout, reset=True):
+    # Opens a port and identifies the board on it, returns the port and the
+    # identity. Without reset DTR stays low, which keeps most boards from
+    # resetting.
+    port = serial.Serial()
+    port.port = portName
+    port.baudrate = speed
+    port.timeout = 0.02
+    port.dtr = reset
+    port.open()
+    try:
+        identity = identify(port, timeout)
+    except serial.SerialException:
+        port.close()
+        raise
+    return port, identity
+
+
+def candidatePorts():
+    # Every serial port the system knows of, for finding boards
+    return sorted(info.device for info in serial.tools.list_ports.comports())
+
+
+# Sampling limits of the firmware, and the longest text line it sends. It
+# refuses a period and oversampling that send samples faster than the port
+# carries them, at ten bits per byte.
+periodRange = (200, 262144)
+oversamplingRange = (1, 64)
+lineBytes = 30
+
+
+def minimumSampleInterval(speed, binary):
+    # μs the link at `speed` baud takes for one sample
+    return (FrameDecoder.frameSize if binary else lineBytes) * 10 * 1_000_000 // speed
+
+
+def checkSampling(speed, binary, period, oversampling):
+    # Raises ValueError for settings the device would refuse
+    if (not periodRange[0] <= period <= periodRange[1]):
+        raise ValueError("Sampling period must be {0} to {1} μs".format(*periodRange))
+    if (not oversamplingRange[0] <= oversampling <= oversamplingRange[1]):
+        raise ValueError("Oversampling must be {0} to {1}".format(*oversamplingRange))
+    minimum = minimumSampleInterval(speed, binary)
+    if (period * oversampling < minimum):
+        raise ValueError("{0} baud carries at most {1:.0f} {2} samples/s, {3} μs per sample".format(
+            speed, 1_000_000 / minimum, "binary" if binary else "text", minimum))
+
+
+# Kinds of device commands. Output commands change what the device puts out
+# and are acknowledged by it, setpoints are output commands that replace an
+# earlier setpoint still waiting to be sent.
+commandPlain = 0
+commandOutput = 1
+commandSetpoint = 2
+
+# Output settings the reader sends again after reconnecting, in this order
+settingOrder = ('protocol', 'sampling', 'voltage', 'range', 'setpoint')
+
+
+class SerialReader(threading.Thread):
+    # Owns the serial port once started. Everything the port has is read in one
+    # call, parsed, scaled and handed to the GUI in batches through a bounded
+    # queue, and commands for the device are queued and written by this thread
+    # between reads, so nothing else ever touches the port.
+    #
+    # Commands that set the output are acknowledged by the device through a
+    # counter in every sample. The reader turns it into the number of output
+    # commands applied since it started, in each sample's 'applied' field, so
+    # outputQueued right after queueing a command is the count at which it is
+    # live. Output commands wait for the first sample, which tells where the
+    # device's counter starts.
+    #
+    # When the port fails, as when a USB adapter drops out, the reader opens it
+    # again without resetting the board and sends every output setting again,
+    # in case the board was reset after all. It only gives up, setting error,
+    # after reconnectTimeout.
+    def __init__(self, port, queueSize=64, batchInterval=0.01, reconnectTimeout=10.0):
+        super().__init__(daemon=True)
+        self.serial = port
+        self.batches = queue.Queue(queueSize)
+        # Queued commands as (data, applied, kind), oldest first. The first
+        # one stays queued while it is written, with sending set.
+        self.commands = collections.deque()
+        self.sending = False
+        self.commandLock = threading.Lock()
+        # The newest command for each of settingOrder
+        self.settings = {}
+        self.outputQueued = 0
+        self.applied = 0
+        self.lastAck = None
+        self.running = True
+        self.error = None
+        self.identity = None
+        self.reconnectTimeout = reconnectTimeout
+        self.reconnecting = False
+        self.parser = LineParser()
+        self.samplePeriod = defaultSamplePeriod
+        self.oversampling = 1
+        # Protocol and sampling as last queued, which the device has once it
+        # has worked through the commands
+        self.requested = {'binary': False, 'period': defaultSamplePeriod, 'oversampling': 1}
+        # Replaced as a whole, so the reader thread always sees a complete one
+        self.calibration = defaultCalibration
+        # Samples read within batchInterval are queued as one batch, so the
+        # queue bounds time rather than the number of reads
+        self.batchInterval = batchInterval
+        self.pending = []
+        self.pendingSince = 0
+
+        # A CaptureWriter, or anything else with write(raw, samples), gets every
+        # batch as it is read
+        self.recorder = None
+
+        self.bytesRead = 0
+        self.samplesRead = 0
+        self.droppedBatches = 0
+        self.droppedSamples = 0
+        self.coalescedSetpoints = 0
+        # Per read: bytes waiting, bytes and samples read, parse time
+        self.metrics = Metrics()
+
+    def write(self, data, applied=None, kind=commandPlain, setting=None):
+        # applied is called from the reader thread right after data is written.
+        # Returns the applied count at which an output command will be live.
+        started = time.perf_counter()
+        with self.commandLock:
+            self.metrics.timing("command lock wait", started)
+            if (setting is not None):
+                self.settings[setting] = (data, applied, kind)
+            if (kind == commandSetpoint and len(self.commands) > self.sending
+                    and self.commands[-1][2] == commandSetpoint):
+                # Not sent yet, so it is overtaken by the new one. Range
+                # switches and other commands in between are kept in order.
+                self.commands[-1] = (data, applied, kind)
+                self.coalescedSetpoints += 1
+                return self.outputQueued
+            self.commands.append((data, applied, kind))
+            if (kind != commandPlain):
+                self.outputQueued += 1
+            return self.outputQueued
+
+    def setpoint(self, value):
+        # DAC code for the output, the latest queued one wins
+        return self.write(("S" + str(value) + "\n").encode('ascii'), kind=commandSetpoint, setting='setpoint')
+
+    def setRange(self, highCurrent):
+        return self.write(b"C" if highCurrent else b"c", kind=commandOutput, setting='range')
+
+    def setVoltageRange(self, highVoltage):
+        self.write(b"V" if highVoltage else b"v", setting='voltage')
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.serial.close()
+
+    def run(self):
+        while self.running:
+            try:
+                self.serve()
+            except (serial.SerialException, OSError) as exc:
+                if (not self.reconnect()):
+                    self.error = exc
+                    return
+            except Exception as exc:
+                # Anything else would end the thread unnoticed, reconnecting
+                # does not help with it
+                self.error = exc
+                return
+
+    def serve(self):
+        while self.running:
+            self.writeCommands()
+            bytesRead = self.bytesRead
+            samples = self.readSamples()
+            if (len(samples) > 0):
+                if (len(self.pending) == 0):
+                    self.pendingSince = time.monotonic()
+                self.pending.append(samples)
+            # Hand over what there is once the interval is up, or right away
+            # when the port has gone quiet
+            if (len(self.pending) > 0 and (self.bytesRead == bytesRead
+                                           or time.monotonic() - self.pendingSince >= self.batchInterval)):
+                self.push(numpy.concatenate(self.pending))
+                self.pending = []
+
+    def reconnect(self):
+        # Tries to open the port again every few milliseconds. The board's
+        # counter may have started over, so output commands wait for a sample
+        # again, and the settings are queued like new commands so the applied
+        # counts stay in step.
+        name, speed = self.serial.port, self.serial.baudrate
+        try:
+            self.serial.close()
+        except (serial.SerialException, OSError):
+            pass
+        self.reconnecting = True
+        deadline = time.monotonic() + self.reconnectTimeout
+        while self.running and time.monotonic() < deadline:
+            try:
+                self.serial, self.identity = connectPort(name, speed, min(probeTimeout, deadline - time.monotonic()),
+                                                         reset=False)
+            except serial.SerialException:
+                time.sleep(0.02)
+                continue
+            self.parser = type(self.parser)()
+            self.lastAck = None
+            with self.commandLock:
+                # Output commands sent before are applied or lost with the
+                # port, the ones still queued count from here. The settings are
+                # queued here rather than through write(), whose lock wait is
+                # only timed on the threads that give commands.
+                held = sum(1 for data, applied, kind in self.commands if kind != commandPlain)
+                self.applied = self.outputQueued - held
+                for key in settingOrder:
+                    if (key in self.settings):
+                        command = self.settings[key]
+                        self.commands.append(command)
+                        if (command[2] != commandPlain):
+                            self.outputQueued += 1
+            self.metrics.count("reconnects")
+            self.reconnecting = False
+            return True
+        self.reconnecting = False
+        return False
+
+    def setBinary(self, binary):
+        # Whatever the device sent before it saw the switch is in the old
+        # format and is skipped by the new parser. Raises ValueError when the
+        # sampling is too fast for text lines.
+        requested = self.requested
+        checkSampling(self.serial.baudrate, binary, requested['period'], requested['oversampling'])
+        requested['binary'] = binary
+        if (binary):
+            self.write(b"B", lambda: setattr(self, 'parser', FrameDecoder()), setting='protocol')
+        else:
+            self.write(b"A", lambda: setattr(self, 'parser', LineParser()), setting='protocol')
+
+    def setSampling(self, period, oversampling):
+        # period in μs between conversions, oversampling conversions per
+        # sample. Raises ValueError for settings the device refuses.
+        requested = self.requested
+        speed = self.serial.baudrate
+        checkSampling(speed, requested['binary'], period, oversampling)
+        # The device checks each of P and N against the other's setting at the
+        # time, so the one that keeps the interval long enough goes first
+        periodCommand = "P" + str(period) + "\n"
+        oversamplingCommand = "N" + str(oversampling) + "\n"
+        if (period * requested['oversampling'] >= minimumSampleInterval(speed, requested['binary'])):
+            command = periodCommand + oversamplingCommand
+        else:
+            command = oversamplingCommand + periodCommand
+        requested['period'] = period
+        requested['oversampling'] = oversampling
+
+        def applied():
+            self.samplePeriod = period
+            self.oversampling = oversampling
+        self.write(command.encode('ascii'), applied, setting='sampling')
+
+    def rate(self):
+        # Samples per second the device sends with the current settings
+        return 1_000_000 / (self.samplePeriod * self.oversampling)
+
+    def requestedRate(self):
+        # Samples per second once the device has the last queued settings,
+        # for commands queued after them
+        return 1_000_000 / (self.requested['period'] * self.requested['oversampling'])
+
+    def writeCommands(self):
+        while True:
+            started = time.perf_counter()
+            with self.commandLock:
+                self.metrics.timing("reader lock wait", started)
+                if (len(self.commands) == 0):
+                    return
+                data, applied, kind = self.commands[0]
+                if (kind != commandPlain and self.lastAck is None):
+                    return
+                self.sending = True
+            started = time.perf_counter()
+            try:
+                self.serial.write(data)
+            except (serial.SerialException, OSError):
+                # Still queued, so it is sent again after reconnecting
+                with self.commandLock:
+                    self.sending = False
+                raise
+            self.metrics.timing("serial write", started)
+            with self.commandLock:
+                self.commands.popleft()
+                self.sending = False
+            if (applied is not None):
+                applied()
+
+    def readSamples(self):
+        # Blocks for at most the port timeout when nothing is waiting
+        metrics = self.metrics
+        waiting = self.serial.in_waiting
+        data = self.serial.read(max(1, waiting))
+        self.bytesRead += len(data)
+        metrics.observe("backlog", waiting, "bytes")
+        metrics.observe("bytes per read", len(data), "bytes")
+        started = time.perf_counter()
+        parser = self.parser
+        malformed, missed = parser.malformed, parser.missed
+        raw = parser.feed(data)
+        samples = scaleSamples(raw, self.calibration)
+        samples['oversampling'] = self.oversampling
+        samples['rate'] = self.rate()
+        if (len(raw) > 0):
+            if (self.lastAck is None):
+                self.lastAck = raw['ack'][0]
+            # The counter wraps at 256, which is far more commands than fit
+            # between two samples
+            applied = self.applied + numpy.cumsum(numpy.diff(raw['ack'], prepend=self.lastAck) & 0xFF)
+            samples['applied'] = applied
+            self.lastAck = raw['ack'][-1]
+            self.applied = int(applied[-1])
+        metrics.timing("parse", started)
+        metrics.observe("samples per read", len(samples))
+        if (parser.malformed != malformed):
+            metrics.count("malformed", parser.malformed - malformed)
+        if (parser.missed != missed):
+            metrics.count("missed", parser.missed - missed)
+        self.samplesRead += len(samples)
+        recorder = self.recorder
+        if (recorder is not None):
+            started = time.perf_counter()
+            recorder.write(raw, samples)
+            metrics.timing("recorder", started)
+        return samples
+
+    def push(self, samples):
+        # When the GUI falls behind the oldest batch is thrown away, so what is
+        # shown stays current and memory use stays bounded.
+        while True:
+            try:
+                self.batches.put_nowait(samples)
+                return
+            except queue.Full:
+                try:
+                    dropped = self.batches.get_nowait()
+                except queue.Empty:
+                    continue
+                self.droppedBatches += 1
+                self.droppedSamples += len(dropped)
+                self.metrics.count("dropped", len(dropped))
+
+    def get(self):
+        batches = []
+        while True:
+            try:
+                batches.append(self.batches.get_nowait())
+            except queue.Empty:
+                break
+        if (len(batches) == 0):
+            return numpy.empty(0, sampleType)
+        return numpy.concatenate(batches)
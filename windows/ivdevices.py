@@ -0,0 +1,222 @@
+import concurrent.futures
+import os
+import time
+import serial
+from ivcore import RingBuffer, DecimationPyramid, LiveStatistics, defaultCalibration, checkSampling, setTenths
+from ivengine import sweepOnDevice, openDevice, closeOpened, writeSetpoint, SweepEngine, analyseSweep
+from ivmetrics import Metrics
+
+
+class SampleStore:
+    # Everything kept of one device's samples: ring buffers with the newest
+    # ones, running statistics and decimation pyramids over the whole history
+    def __init__(self, size):
+        self.statistics = LiveStatistics(size)
+        self.dropSamples = self.statistics.drop.buffer
+        self.currentSamples = RingBuffer(size)
+        self.currentSetSamples = RingBuffer(size)
+        self.currentErrorSamples = self.statistics.currentError.buffer
+        self.dropHistory = DecimationPyramid(self.dropSamples)
+        self.currentHistory = DecimationPyramid(self.currentSamples)
+        self.currentErrorHistory = DecimationPyramid(self.currentErrorSamples)
+
+    def extend(self, samples):
+        if (len(samples) == 0):
+            return
+        self.currentSetSamples.extend(samples['currentSet'])
+        self.currentSamples.extend(samples['currentRead'])
+        self.statistics.extend(samples)
+        self.dropHistory.extend(samples['voltageDrop'])
+        self.currentHistory.extend(samples['currentRead'])
+        self.currentErrorHistory.extend(samples['currentRead'] - samples['currentSet'])
+
+
+class Device:
+    # One board: its reader, the samples it sent and its sweep, if one runs.
+    # A replayed capture is a device too, with a CaptureReplay as its reader
+    # that nothing is written to.
+    def __init__(self, name, reader, storeSize, replay=False):
+        self.name = name
+        self.reader = reader
+        self.replay = replay
+        self.store = SampleStore(storeSize)
+        self.sweep = None
+        self.recorder = None
+        # The board resets when the port is opened
+        self.current = 0
+        self.highCurrent = False
+
+    def poll(self):
+        samples = self.reader.get()
+        if (self.replay):
+            self.followReplaySweep(samples)
+        self.store.extend(samples)
+        if (self.sweep is not None):
+            self.sweep.feed(samples)
+        return samples
+
+    def write(self, data):
+        if (not self.replay):
+            self.reader.write(data)
+
+    def setVoltageRange(self, highVoltage):
+        if (not self.replay):
+            self.reader.setVoltageRange(highVoltage)
+
+    def setRange(self, highCurrent):
+        if (self.replay):
+            return
+        self.highCurrent = highCurrent
+        self.reader.setRange(highCurrent)
+
+    def setCurrent(self, value):
+        if (self.replay):
+            return
+        self.current = value
+        self.highCurrent = writeSetpoint(self.reader, value, self.highCurrent)
+
+    def startSweep(self, start, end, step, dwell, mode, settleTolerance, settleSamples):
+        if (self.replay):
+            return
+        self.sweep = SweepEngine(self.reader, start, end, step, dwell, mode, settleTolerance, settleSamples,
+                                 self.highCurrent)
+        self.sweep.begin()
+        self.highCurrent = self.sweep.highCurrent
+
+    def finishSweep(self):
+        # Ends the sweep, leaving the output where it finished, and returns it
+        engine = self.sweep
+        self.sweep = None
+        engine.finish(self.store.statistics.latest)
+        self.current = engine.current
+        self.highCurrent = engine.highCurrent
+        return engine
+
+    def followReplaySweep(self, samples):
+        # Sweeps the device ran while recording are aggregated again as they
+        # are replayed, the same way as a live device sweep. Their range is not
+        # recorded, so it is taken from the set values seen.
+        tagged = samples[samples['step'] >= 0]
+        if (len(tagged) == 0):
+            return
+        if (self.sweep is None):
+            start = int(setTenths(tagged[0]))
+            self.sweep = SweepEngine(None, start, start, 1, 0, sweepOnDevice, highCurrent=self.highCurrent)
+            self.sweep.begin()
+        self.sweep.end = max(self.sweep.end, int(setTenths(tagged).max()))
+
+    def close(self):
+        if (self.recorder is not None):
+            self.reader.recorder = None
+            self.recorder.stop()
+            self.recorder = None
+        if (not self.replay):
+            self.reader.stop()
+
+
+class DeviceManager:
+    # The open boards. Ports are opened in parallel in the background and every
+    # board has its own reader thread and sample store. Finished sweeps are analysed in worker
+    # processes, so many boards finishing together do not hold up the caller.
+    def __init__(self, storeSize, workers=None):
+        self.storeSize = storeSize
+        self.workers = workers
+        self.devices = []
+        self.pool = None
+        # Ports being opened, as (port, whether failing is an error, future)
+        self.opener = None
+        self.opening = []
+        # Polling time and how long finished sweeps wait for their analysis
+        self.metrics = Metrics()
+
+    def startOpening(self, ports, speed, binary, samplePeriod, oversampling, calibration=defaultCalibration,
+                     report=True):
+        # Starts opening the ports, finishOpening() picks up the results. Ports
+        # open or being opened already are left alone. With report False, ports
+        # without a board are not failures, for probing every port there is.
+        # Raises ValueError for sampling the device refuses.
+        checkSampling(speed, binary, samplePeriod, oversampling)
+        if (self.opener is None):
+            self.opener = concurrent.futures.ThreadPoolExecutor(32)
+        busy = {device.name for device in self.devices} | {port for port, reporting, future in self.opening}
+        for port in ports:
+            if (port not in busy):
+                self.opening.append((port, report, self.opener.submit(openDevice, port, speed, binary, samplePeriod,
+                                                                      oversampling, calibration)))
+
+    def finishOpening(self):
+        # The devices opened since the last call, and (port, exception) for
+        # every port that failed
+        opened = []
+        failures = []
+        pending = []
+        for port, report, future in self.opening:
+            if (not future.done()):
+                pending.append((port, report, future))
+                continue
+            try:
+                device = Device(port, future.result(), self.storeSize)
+            except serial.SerialException as exc:
+                if (report):
+                    failures.append((port, exc))
+                continue
+            self.devices.append(device)
+            opened.append(device)
+        self.opening = pending
+        return opened, failures
+
+    def cancelOpening(self):
+        # Ports still being opened are closed as soon as they are
+        for port, report, future in self.opening:
+            future.add_done_callback(closeOpened)
+        self.opening = []
+
+    def open(self, ports, speed, binary, samplePeriod, oversampling, calibration=defaultCalibration):
+        # Waits for the ports to open, returns (port, exception) for every port
+        # that failed
+        self.startOpening(ports, speed, binary, samplePeriod, oversampling, calibration)
+        concurrent.futures.wait([future for port, report, future in self.opening])
+        return self.finishOpening()[1]
+
+    def addReplay(self, name, replay):
+        device = Device(name, replay, self.storeSize, replay=True)
+        self.devices.append(device)
+        return device
+
+    def close(self, device=None):
+        # Closes one device, or all of them
+        for closing in ([device] if device is not None else list(self.devices)):
+            closing.close()
+            self.devices.remove(closing)
+
+    def poll(self):
+        # Takes what every device has read. Returns the devices whose reader
+        # failed, with the error, so the caller can close and report them.
+        failed = []
+        started = time.perf_counter()
+        for device in self.devices:
+            if (device.reader.error is not None):
+                failed.append((device, device.reader.error))
+                continue
+            device.poll()
+        self.metrics.timing("poll", started)
+        return failed
+
+    def analyse(self, engine):
+        # Final curves of a finished sweep, as a future. The caller records
+        # its "sweep analysis" time once it has the result, on its own thread.
+        if (self.pool is None):
+            workers = self.workers or min(max(len(self.devices), 1), os.cpu_count() or 1)
+            self.pool = concurrent.futures.ProcessPoolExecutor(workers)
+        volts, current = engine.points()
+        return self.pool.submit(analyseSweep, volts, current, *engine.curveRange())
+
+    def shutdown(self):
+        self.cancelOpening()
+        self.close()
+        if (self.opener is not None):
+            self.opener.shutdown(wait=False)
+            self.opener = None
+        if (self.pool is not None):
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
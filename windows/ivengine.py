@@ -0,0 +1,353 @@
+import argparse
+import concurrent.futures
+import sqlite3
+import sys
+import time
+import numpy
+import serial
+from ivcore import (defaultSamplePeriod, defaultCalibration, Calibration, SettleDetector, settleTimeType,
+                    SweepAggregator, SerialReader, aggregateSweep, probeTimeout, connectPort, candidatePorts,
+                    checkSampling, setTenths)
+from ivfit import fitCurve, describeFit
+from ivlibrary import SweepLibrary
+
+# Everything needed to run the device and sweeps without a GUI, for scripted
+# characterisation runs. Nothing here may import Qt or pyqtgraph.
+
+# Sweep modes: step after a fixed dwell, step once the drop voltage has
+# settled (fixed dwell as the maximum), or run the whole sweep on the device
+sweepFixed = 0
+sweepSettle = 1
+sweepOnDevice = 2
+sweepModeNames = ["Fixed dwell", "Settle detection", "On device"]
+
+# Set currents above this many tenths of μA need the high current range,
+# where the DAC counts in steps of 10μA
+highCurrentThreshold = 4096
+
+
+def openDevice(portName, speed, binary=False, samplePeriod=defaultSamplePeriod, oversampling=1,
+               calibration=defaultCalibration, timeout=probeTimeout):
+    # Opens the port, makes sure an IV-grapher answers on it and returns a
+    # running SerialReader. Raises serial.SerialException on failure and
+    # ValueError, before opening anything, for sampling the device refuses.
+    checkSampling(speed, binary, samplePeriod, oversampling)
+    port, identity = connectPort(portName, speed, timeout)
+    if (binary and 'binary' not in identity['capabilities']):
+        port.close()
+        raise serial.SerialException(portName + " has firmware " + identity['version']
+                                     + " without the binary protocol")
+    reader = SerialReader(port)
+    reader.identity = identity
+    reader.calibration = calibration
+    reader.start()
+    # Set explicitly, as a device that was not reset may still use either
+    reader.setBinary(binary)
+    reader.setSampling(samplePeriod, oversampling)
+    return reader
+
+
+def openFirst(ports, speed, binary=False, samplePeriod=defaultSamplePeriod, oversampling=1,
+              calibration=defaultCalibration):
+    # Tries all ports at once and returns the port name and reader of the
+    # first board that answers, without waiting for the other ports. Boards
+    # that answer later are closed. Raises serial.SerialException if there is
+    # none, ValueError like openDevice().
+    checkSampling(speed, binary, samplePeriod, oversampling)
+    if (len(ports) == 0):
+        raise serial.SerialException("No serial ports found")
+    opener = concurrent.futures.ThreadPoolExecutor(len(ports))
+    futures = {opener.submit(openDevice, port, speed, binary, samplePeriod, oversampling, calibration): port
+               for port in ports}
+    opener.shutdown(wait=False)
+    for future in concurrent.futures.as_completed(futures):
+        if (future.exception() is None):
+            for other in futures:
+                if (other is not future):
+                    other.add_done_callback(closeOpened)
+            return futures[future], future.result()
+    raise serial.SerialException("No IV-grapher answered on " + ", ".join(ports))
+
+
+def closeOpened(future):
+    # For futures of openDevice() whose reader is not wanted
+    if (future.exception() is None):
+        future.result().stop()
+
+
+def writeSetpoint(reader, value, highCurrent):
+    # Sets the output to `value` tenths of μA, switching range when needed, or
+    # always when highCurrent is None because the range is not known. The range
+    # is switched on the side that avoids overshooting the target. Returns
+    # whether the high current range is now in use. Setpoints not yet sent
+    # are replaced, the reader's outputQueued afterwards is when it is live.
+    if (value > highCurrentThreshold):
+        reader.setpoint(int(value / 100))
+        if (highCurrent is not True):
+            reader.setRange(True)
+        return True
+    if (highCurrent is not False):
+        reader.setRange(False)
+    reader.setpoint(value)
+    return False
+
+
+def deviceValue(value):
+    # The set value the device reports back for `value` tenths of μA. In the
+    # high current range the last two digits are lost.
+    if (value > highCurrentThreshold):
+        return int(value / 100) * 100
+    return value
+
+
+class SweepEngine:
+    # Runs one sweep over a SerialReader. Currents are in tenths of μA and
+    # steps above highCurrentThreshold are a hundred times larger, like the
+    # device's own sweep programs. The owner passes every sample batch to
+    # feed() and calls poll() at least by deadline, so it can be driven from a
+    # plain loop or from GUI timers. With no reader it only aggregates, for
+    # replaying recorded device sweeps.
+    def __init__(self, reader, start, end, step, dwell, mode=sweepFixed, settleTolerance=0.002, settleSamples=5,
+                 highCurrent=None):
+        # dwell in seconds, settleTolerance in volts, highCurrent the present
+        # range or None if not known
+        self.reader = reader
+        self.start = start
+        self.end = end
+        self.step = step
+        self.dwell = dwell
+        self.mode = mode
+        self.highCurrent = highCurrent
+        self.settleDetector = SettleDetector(settleSamples, settleTolerance)
+        self.settleTimes = []
+        self.aggregator = SweepAggregator()
+        # The (volts, current) batches that went into the aggregator
+        self.pointBatches = []
+
+        self.current = start
+        self.setTenths = deviceValue(start)
+        # The reader's applied count at which each step became live. Samples
+        # with other counts were taken at the previous step or half way
+        # through a range switch.
+        self.stepApplied = []
+        self.stepsSeen = False
+        self.running = False
+        self.deadline = None
+
+    def begin(self):
+        self.running = True
+        if (self.mode == sweepOnDevice):
+            if (self.reader is not None):
+                self.beginOnDevice()
+            return
+        self.highCurrent = writeSetpoint(self.reader, self.current, self.highCurrent)
+        self.startStep()
+
+    def beginOnDevice(self):
+        # The whole sweep goes to the device in one command and is stepped by
+        # its sample timer, so the dwell time becomes a number of samples at
+        # the sampling queued before it, which may not be applied yet
+        dwell = max(1, round(self.dwell * self.reader.requestedRate()))
+        program = "W" + ";".join(str(i) for i in (self.start, self.end, self.step, dwell, highCurrentThreshold))
+        self.reader.write((program + "\n").encode('ascii'))
+
+    def startStep(self):
+        self.stepApplied.append(self.reader.outputQueued)
+        self.setTenths = deviceValue(self.current)
+        self.settleDetector.reset()
+        # In settle mode the fixed dwell is the maximum for a step
+        self.deadline = time.monotonic() + self.dwell
+
+    def feed(self, samples):
+        if (not self.running or len(samples) == 0):
+            return
+        if (self.mode == sweepOnDevice):
+            self.feedOnDevice(samples)
+            return
+        self.aggregate(samples[numpy.isin(samples['applied'], self.stepApplied)])
+        if (self.mode == sweepSettle):
+            current = samples[samples['applied'] == self.stepApplied[-1]]
+            if (self.settleDetector.extend(current['voltageDrop'])):
+                self.advance(settled=True)
+
+    def feedOnDevice(self, samples):
+        # Only samples the device tagged with a step belong to the sweep. Once
+        # tagged samples have been seen, an untagged one means it is done.
+        tagged = samples[samples['step'] >= 0]
+        self.aggregate(tagged)
+        if (len(tagged) > 0):
+            self.stepsSeen = True
+            self.current = int(setTenths(tagged[-1]))
+        if (self.stepsSeen and samples['step'][-1] < 0):
+            self.finish(samples[-1])
+
+    def aggregate(self, samples):
+        self.aggregator.extend(samples['voltageDrop'], samples['correctedCurrent'])
+        self.pointBatches.append((samples['voltageDrop'], samples['correctedCurrent']))
+
+    def points(self):
+        # Every sweep point so far as volts, current
+        if (len(self.pointBatches) == 0):
+            return numpy.empty(0), numpy.empty(0)
+        self.pointBatches = [tuple(numpy.concatenate(column) for column in zip(*self.pointBatches))]
+        return self.pointBatches[0]
+
+    def poll(self):
+        if (self.running and self.deadline is not None and time.monotonic() >= self.deadline):
+            # How late the step is against its dwell time
+            self.reader.metrics.observe("sweep step late", 1000 * (time.monotonic() - self.deadline), "ms")
+            self.advance(settled=False)
+
+    def advance(self, settled):
+        if (self.mode == sweepSettle):
+            self.settleTimes.append((self.setTenths / 10, self.settleDetector.elapsed(), settled))
+        if (self.current > highCurrentThreshold):
+            self.current += self.step * 100
+        else:
+            self.current += self.step
+        if (self.current > self.end):
+            self.current = self.end
+            self.highCurrent = writeSetpoint(self.reader, self.current, self.highCurrent)
+            self.finish()
+            return
+        self.highCurrent = writeSetpoint(self.reader, self.current, self.highCurrent)
+        self.startStep()
+
+    def finish(self, latest=None):
+        # Ends the sweep early or after its last step. A device sweep chose the
+        # range itself, so the output and range are taken from its newest sample.
+        if (not self.running):
+            return
+        self.running = False
+        self.deadline = None
+        if (self.mode == sweepOnDevice):
+            if (self.reader is not None):
+                self.reader.write(b"w")
+            if (latest is not None):
+                self.current = int(setTenths(latest))
+                self.highCurrent = bool(latest['highCurrent'])
+
+    def curveRange(self):
+        # Ranges are 10% of the total range above and below.
+        # Currents are in 100nA increments, so divide by 10.
+        range = self.end - self.start
+        low = (self.start - (range / 10)) / 10
+        high = (self.end + (range / 10)) / 10
+        return low, high
+
+    def curves(self):
+        return self.aggregator.curves(*self.curveRange())
+
+    def settleSummary(self):
+        return numpy.array(self.settleTimes, settleTimeType)
+
+    def settings(self):
+        # What the sweep was asked to do, in μA and seconds, for the library
+        return {'start': self.start / 10, 'end': self.end / 10, 'step': self.step / 10, 'dwell': self.dwell,
+                'mode': self.mode}
+
+
+def analyseSweep(volts, current, low, high):
+    # Average, maximum and minimum curves of a finished sweep from its points,
+    # within [low, high] μA, and the model fits of the average, best first.
+    # Runs in worker processes, so only takes arrays.
+    keep = (current >= low) & (current <= high)
+    navg, nmax, nmin = aggregateSweep(volts[keep], numpy.round(current[keep], 1))
+    return navg, nmax, nmin, fitCurve(navg['current'], navg['volts'])
+
+
+def run(engine, timeout=None):
+    # Drives a sweep to the end from a plain loop. Raises the reader's error
+    # when it fails, mostly serial.SerialException or OSError.
+    engine.begin()
+    started = time.monotonic()
+    while engine.running:
+        if (engine.reader.error is not None):
+            raise engine.reader.error
+        engine.feed(engine.reader.get())
+        engine.poll()
+        if (timeout is not None and time.monotonic() - started > timeout):
+            engine.finish()
+            raise TimeoutError("Sweep did not finish in " + str(timeout) + " s")
+        time.sleep(0.005)
+
+
+def save(path, engine):
+    # .npz keeps the curves and settle times as structured arrays, anything
+    # else is written as CSV with one row per current
+    navg, nmax, nmin = engine.curves()
+    if (path.endswith(".npz")):
+        numpy.savez(path, average=navg, maximum=nmax, minimum=nmin, settleTimes=engine.settleSummary())
+        return
+    table = numpy.column_stack((navg['current'], navg['volts'], nmin['volts'], nmax['volts']))
+    numpy.savetxt(path, table, delimiter=",", fmt="%.6g", header="current_uA,volts_avg,volts_min,volts_max",
+                  comments="")
+
+
+def main():
+    modes = {"fixed": sweepFixed, "settle": sweepSettle, "device": sweepOnDevice}
+    parser = argparse.ArgumentParser(description="Run an IV sweep without the GUI")
+    parser.add_argument("port", help="serial port, or auto to use the first board found")
+    parser.add_argument("output", help="results file, .npz or .csv")
+    parser.add_argument("--speed", type=int, default=14400)
+    parser.add_argument("--start", type=float, default=0.0, help="μA")
+    parser.add_argument("--end", type=float, default=100.0, help="μA")
+    parser.add_argument("--step", type=float, default=0.1, help="μA, x100 above 409.6μA")
+    parser.add_argument("--dwell", type=float, default=200, help="ms per step")
+    parser.add_argument("--mode", choices=sorted(modes), default="fixed")
+    parser.add_argument("--settle-tolerance", type=float, default=2, help="mV")
+    parser.add_argument("--settle-samples", type=int, default=5)
+    parser.add_argument("--binary", action="store_true", help="use the binary sample protocol")
+    parser.add_argument("--period", type=float, default=defaultSamplePeriod / 1000, help="sample period in ms")
+    parser.add_argument("--oversampling", type=int, default=1)
+    parser.add_argument("--calibration", help="calibration file from ivcalibrate.py")
+    parser.add_argument("--timeout", type=float, default=None, help="give up after this many seconds")
+    parser.add_argument("--library", help="also store the sweep in this sweep library directory")
+    parser.add_argument("--name", default="", help="sweep name in the library")
+    args = parser.parse_args()
+
+    calibration = defaultCalibration
+    if (args.calibration):
+        try:
+            calibration = Calibration.load(args.calibration)
+        except (OSError, ValueError, KeyError) as exc:
+            sys.exit("Reading " + args.calibration + " failed: " + str(exc))
+    try:
+        if (args.port == "auto"):
+            args.port, reader = openFirst(candidatePorts(), args.speed, args.binary, int(1000 * args.period),
+                                          args.oversampling, calibration)
+            print("Using " + args.port)
+        else:
+            reader = openDevice(args.port, args.speed, args.binary, int(1000 * args.period), args.oversampling,
+                                calibration)
+    except (serial.SerialException, ValueError) as exc:
+        sys.exit("Opening " + args.port + " failed: " + str(exc))
+    engine = SweepEngine(reader, int(10 * args.start), int(10 * args.end), int(10 * args.step), args.dwell / 1000,
+                         modes[args.mode], args.settle_tolerance / 1000, args.settle_samples)
+    try:
+        run(engine, args.timeout)
+    except (serial.SerialException, OSError, ValueError) as exc:
+        sys.exit("Sweep failed: " + str(exc))
+    finally:
+        reader.stop()
+
+    save(args.output, engine)
+    navg = engine.curves()[0]
+    print("{0} points, {1:.1f} to {2:.1f} μA, written to {3}".format(
+        len(navg), navg['current'].min() if len(navg) else 0, navg['current'].max() if len(navg) else 0,
+        args.output))
+    fits = fitCurve(navg['current'], navg['volts'])
+    for fit in fits:
+        print("  " + describeFit(fit))
+    if (args.library and len(navg) > 0):
+        try:
+            library = SweepLibrary(args.library)
+            id = library.add(args.name, args.port, engine.settings(), engine.points(), engine.curves(), fits)
+            library.close()
+        except (OSError, sqlite3.Error) as exc:
+            sys.exit("Storing in " + args.library + " failed: " + str(exc))
+        print("Stored as sweep " + str(id) + " in " + args.library)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import concurrent.futures
+import csv
+import os
+import sys
+import time
+import numpy
+
+# Model fits for IV curves, on the averaged curves sweeps produce: voltage in V
+# over current in μA, as curvePointType arrays or the columns of a saved sweep.
+# Every model is fitted in closed form with numpy, so a curve takes well under a
+# millisecond, and whole directories of saved sweeps are fitted on all cores.
+# Nothing here may import Qt or pyqtgraph.
+
+# Thermal voltage at room temperature
+thermalVoltage = 0.02585
+
+# The forward region of a curve is above these: what the current reading shows
+# with nothing flowing, in μA, and a few codes of the drop voltage in V. A
+# diode is not forward biased below, and its model does not hold there.
+noiseCurrent = 0.5
+noiseVolts = 0.02
+
+# Ideality factors of real diodes and LEDs. A noisy curve can still give a
+# diode fit outside this, or with negative series resistance.
+idealityRange = (0.8, 4.0)
+
+
+def linearFit(columns, volts):
+    # Least squares over the given columns, returns the coefficients and residuals
+    coefficients = numpy.linalg.lstsq(columns, volts, rcond=None)[0]
+    return coefficients, volts - columns @ coefficients
+
+
+def fitResistor(current, volts):
+    # V = R I + offset
+    amps = current / 1_000_000
+    (resistance, offset), residuals = linearFit(numpy.column_stack((amps, numpy.ones(len(amps)))), volts)
+    return {'resistance': resistance, 'offset': offset}, residuals
+
+
+def fitDiode(current, volts):
+    # Shockley diode with series resistance, V = n Vt ln(I / Is) + I Rs, well
+    # above Is. Linear in n Vt, -n Vt ln(Is) and Rs.
+    amps = current / 1_000_000
+    (slope, intercept, seriesResistance), residuals = linearFit(
+        numpy.column_stack((numpy.log(amps), numpy.ones(len(amps)), amps)), volts)
+    return {'ideality': slope / thermalVoltage, 'saturationCurrent': numpy.exp(-intercept / slope),
+            'seriesResistance': seriesResistance}, residuals
+
+
+def fitKnee(current, volts):
+    # Two straight lines meeting at the knee, like a Zener diode going into
+    # breakdown. Every split point is tried at once from cumulative sums. Only
+    # knees within the curve where the slope drops to a flatter, rising one
+    # count, anything else is a straight line or noise.
+    amps = current / 1_000_000
+    n = len(amps)
+    sums = [numpy.cumsum(values) for values in (numpy.ones(n), amps, volts, amps * amps, amps * volts,
+                                                  volts * volts)]
+    totals = [s[-1] for s in sums]
+    # Segment sums for the first k points and for the rest. Each segment
+    # needs a tenth of the points, so a few stray ones at an end are no knee.
+    shortest = max(3, n // 10)
+    k = numpy.arange(shortest, n - shortest + 1)
+    before = [s[k - 1] for s in sums]
+    after = [total - s[k - 1] for total, s in zip(totals, sums)]
+
+    def segment(count, x, y, xx, xy, yy):
+        spread = count * xx - x * x
+        slope = (count * xy - x * y) / spread
+        intercept = (y - slope * x) / count
+        error = yy - slope * xy - intercept * y
+        return slope, intercept, error
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        lowSlope, lowIntercept, lowError = segment(*before)
+        highSlope, highIntercept, highError = segment(*after)
+        knees = (highIntercept - lowIntercept) / (lowSlope - highSlope)
+        valid = ((highSlope >= 0) & (highSlope < lowSlope) & (knees >= amps[0]) & (knees <= amps[-1])
+                 & numpy.isfinite(lowError + highError))
+    if (not numpy.any(valid)):
+        return {'kneeCurrent': numpy.nan, 'kneeVoltage': numpy.nan, 'resistanceBelow': numpy.nan,
+                'resistanceAbove': numpy.nan}, volts
+    best = int(numpy.argmin(numpy.where(valid, lowError + highError, numpy.inf)))
+    split = k[best]
+    kneeAmps = knees[best]
+    fitted = numpy.concatenate((lowSlope[best] * amps[:split] + lowIntercept[best],
+                                highSlope[best] * amps[split:] + highIntercept[best]))
+    return {'kneeCurrent': kneeAmps, 'kneeVoltage': lowSlope[best] * kneeAmps + lowIntercept[best],
+            'resistanceBelow': lowSlope[best], 'resistanceAbove': highSlope[best]}, volts - fitted
+
+
+# Fit function, number of parameters, the fewest points it needs and whether it
+# is only fitted to the forward region
+models = {'resistor': (fitResistor, 2, 3, False), 'diode': (fitDiode, 3, 4, True), 'knee': (fitKnee, 4, 8, False)}
+
+
+def plausible(model, parameters):
+    if (model == 'diode'):
+        return (idealityRange[0] <= parameters['ideality'] <= idealityRange[1]
+                and parameters['seriesResistance'] >= 0)
+    return True
+
+
+def modelVoltage(fit, current):
+    # Voltage the fitted model gives at `current` μA
+    amps = current / 1_000_000
+    parameters = fit['parameters']
+    if (fit['model'] == 'resistor'):
+        return parameters['resistance'] * amps + parameters['offset']
+    if (fit['model'] == 'diode'):
+        with numpy.errstate(divide='ignore'):
+            return (parameters['ideality'] * thermalVoltage * numpy.log(amps / parameters['saturationCurrent'])
+                    + parameters['seriesResistance'] * amps)
+    knee = parameters['kneeCurrent']
+    return numpy.where(amps < knee, parameters['kneeVoltage'] + parameters['resistanceBelow'] * (amps - knee),
+                       parameters['kneeVoltage'] + parameters['resistanceAbove'] * (amps - knee))
+
+
+def fitCurve(current, volts, names=tuple(models)):
+    # Fits every named model to a curve. Returns a list of dicts with the
+    # model, its parameters, residuals in V, their rms and a BIC score to
+    # compare models by, lowest first. Models the curve has too few points
+    # for, or that only fit with implausible parameters, are left out.
+    # Residuals and scores are over the forward region for every model, so
+    # the scores compare.
+    keep = (current > 0) & numpy.isfinite(volts)
+    order = numpy.argsort(current[keep], kind='stable')
+    current = current[keep][order]
+    volts = volts[keep][order]
+    forward = (current > noiseCurrent) & (volts > noiseVolts)
+    count = int(numpy.count_nonzero(forward))
+    fits = []
+    for name in names:
+        function, parameterCount, minimum, forwardOnly = models[name]
+        if (count < minimum):
+            continue
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            if (forwardOnly):
+                parameters, residuals = function(current[forward], volts[forward])
+            else:
+                parameters, residuals = function(current, volts)
+                residuals = residuals[forward]
+            squares = max(float(numpy.sum(residuals * residuals)), 1e-30)
+            score = count * numpy.log(squares / count) + parameterCount * numpy.log(count)
+        if (not numpy.all(numpy.isfinite(list(parameters.values()))) or not plausible(name, parameters)):
+            continue
+        fits.append({'model': name, 'parameters': {key: float(value) for key, value in parameters.items()},
+                     'current': current[forward], 'residuals': residuals, 'rms': float(numpy.sqrt(squares / count)),
+                     'score': float(score)})
+    fits.sort(key=lambda fit: fit['score'])
+    return fits
+
+
+def describeFit(fit):
+    parameters = fit['parameters']
+    if (fit['model'] == 'resistor'):
+        text = "R = {0:.5g} Ω".format(parameters['resistance'])
+    elif (fit['model'] == 'diode'):
+        text = "n = {0:.3f}, Is = {1:.3g} A, Rs = {2:.3g} Ω".format(
+            parameters['ideality'], parameters['saturationCurrent'], parameters['seriesResistance'])
+    else:
+        text = "knee {0:.4g} V at {1:.4g} μA, {2:.3g} Ω above".format(
+            parameters['kneeVoltage'], 1_000_000 * parameters['kneeCurrent'], parameters['resistanceAbove'])
+    return "{0}: {1}, rms {2:.2f} mV".format(fit['model'].capitalize(), text, 1000 * fit['rms'])
+
+
+def loadSweep(path):
+    # The averaged curve of a sweep saved by ivengine, as current, volts
+    if (path.endswith(".npz")):
+        with numpy.load(path) as data:
+            average = data['average']
+        return average['current'], average['volts']
+    table = numpy.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    return table[:, 0], table[:, 1]
+
+
+def fitFile(path):
+    # For the process pool: the fits of one saved sweep without residuals, or
+    # the error message
+    try:
+        fits = fitCurve(*loadSweep(path))
+    except (OSError, ValueError, KeyError, IndexError) as exc:
+        return path, None, str(exc)
+    for fit in fits:
+        del fit['current']
+        del fit['residuals']
+    return path, fits, None
+
+
+def fitDirectory(directory, workers=None):
+    # Fits every saved sweep in the directory on all cores, in name order
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.endswith((".npz", ".csv")))
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(fitFile, paths, chunksize=max(1, len(paths) // (4 * workers))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit IV models to a directory of saved sweeps")
+    parser.add_argument("directory")
+    parser.add_argument("output", help="CSV file with one row per sweep and model")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    results = fitDirectory(args.directory, args.workers)
+    failed = 0
+    with open(args.output, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["file", "model", "rank", "rms_V", "score", "parameters"])
+        for path, fits, error in results:
+            if (fits is None):
+                failed += 1
+                print(path + ": " + error, file=sys.stderr)
+                continue
+            for rank, fit in enumerate(fits):
+                writer.writerow([os.path.basename(path), fit['model'], rank, "{0:.6g}".format(fit['rms']),
+                                 "{0:.6g}".format(fit['score']),
+                                 ";".join("{0}={1:.6g}".format(key, value) for key, value in fit['parameters'].items())])
+    print("{0} sweeps fitted in {1:.2f} s, {2} failed, written to {3}".format(
+        len(results) - failed, time.monotonic() - started, failed, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import functools
+import json
+import os
+import sqlite3
+import time
+import numpy
+
+# Finished sweeps on disk, for reopening and comparing. Every sweep is an .npz
+# file with its points and its average, maximum and minimum curves, the same
+# keys ivengine.save() writes, so ivfit.py can fit a whole library directory.
+# An SQLite index holds the settings, the time and the best fit of each, so
+# thousands of sweeps are filtered without opening any file, and decoded
+# curves are kept in an LRU cache. Nothing here may import Qt or pyqtgraph.
+
+defaultLibrary = os.path.join(os.path.expanduser("~"), "iv-grapher-library")
+
+schema = """
+CREATE TABLE IF NOT EXISTS sweeps (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    device TEXT NOT NULL,
+    created REAL NOT NULL,
+    start REAL, end REAL, step REAL, dwell REAL, mode INTEGER,
+    points INTEGER,
+    model TEXT,
+    parameters TEXT,
+    file TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sweepsCreated ON sweeps (created);
+CREATE INDEX IF NOT EXISTS sweepsName ON sweeps (name);
+"""
+
+# Index columns a query can be narrowed by, with the SQL test for each
+filters = {'name': "name LIKE '%' || ? || '%'", 'device': "device = ?", 'since': "created >= ?",
+           'until': "created < ?", 'mode': "mode = ?", 'model': "model = ?", 'start': "start = ?", 'end': "end = ?",
+           'step': "step = ?"}
+
+
+class SweepLibrary:
+    # Sweeps are only added and deleted, never changed, so cached curves stay
+    # valid until their sweep is deleted
+    def __init__(self, directory=defaultLibrary, cacheSize=128):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.database = sqlite3.connect(os.path.join(directory, "index.sqlite"))
+        self.database.row_factory = sqlite3.Row
+        self.database.executescript(schema)
+        self.curves = functools.lru_cache(maxsize=cacheSize)(self.readCurves)
+
+    def add(self, name, device, settings, points, curves, fits=()):
+        # settings has start, end, step in μA, dwell in s and mode, points is
+        # (volts, current), curves (average, maximum, minimum) and fits as from
+        # ivfit.fitCurve(), best first. Returns the new sweep's id.
+        created = time.time()
+        volts, current = points
+        average, maximum, minimum = curves
+        best = fits[0] if len(fits) > 0 else None
+        # The file is named after the new row's id, as the clock may not have
+        # moved on between sweeps stored together. A failed write leaves no row.
+        with self.database:
+            cursor = self.database.execute(
+                "INSERT INTO sweeps (name, device, created, start, end, step, dwell, mode, points, model, parameters,"
+                " file) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '')",
+                (name, device, created, settings['start'], settings['end'], settings['step'], settings['dwell'],
+                 settings['mode'], len(volts), best['model'] if best else None,
+                 json.dumps(best['parameters']) if best else None))
+            id = cursor.lastrowid
+            file = time.strftime("%Y%m%d-%H%M%S", time.localtime(created)) + "-{0:06d}.npz".format(id)
+            numpy.savez(os.path.join(self.directory, file), volts=volts, current=current, average=average,
+                        maximum=maximum, minimum=minimum)
+            self.database.execute("UPDATE sweeps SET file = ? WHERE id = ?", (file, id))
+        return id
+
+    def find(self, limit=1000, **conditions):
+        # Index rows as dicts, newest first, narrowed by any of `filters`
+        # given as keyword arguments. Parameters of the best fit are decoded.
+        unknown = set(conditions) - set(filters)
+        if (len(unknown) > 0):
+            raise KeyError("Unknown sweep filters: " + ", ".join(sorted(unknown)))
+        clauses = [filters[key] for key in conditions]
+        query = "SELECT * FROM sweeps"
+        if (len(clauses) > 0):
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY created DESC LIMIT ?"
+        rows = [dict(row) for row in self.database.execute(query, list(conditions.values()) + [limit])]
+        for row in rows:
+            row['parameters'] = json.loads(row['parameters']) if row['parameters'] else {}
+        return rows
+
+    def get(self, id):
+        rows = [dict(row) for row in self.database.execute("SELECT * FROM sweeps WHERE id = ?", (id,))]
+        if (len(rows) == 0):
+            raise KeyError("No sweep " + str(id))
+        return rows[0]
+
+    def readCurves(self, id):
+        # Through self.curves(id): average, maximum and minimum, read only as
+        # the cache hands the same arrays to every caller
+        with numpy.load(os.path.join(self.directory, self.get(id)['file'])) as data:
+            curves = (data['average'], data['maximum'], data['minimum'])
+        for curve in curves:
+            curve.flags.writeable = False
+        return curves
+
+    def points(self, id):
+        # Every point of the sweep as (volts, current), not cached
+        with numpy.load(os.path.join(self.directory, self.get(id)['file'])) as data:
+            return data['volts'], data['current']
+
+    def delete(self, id):
+        file = self.get(id)['file']
+        with self.database:
+            self.database.execute("DELETE FROM sweeps WHERE id = ?", (id,))
+        try:
+            os.remove(os.path.join(self.directory, file))
+        except FileNotFoundError:
+            pass
+        self.curves.cache_clear()
+
+    def close(self):
+        self.database.close()
@@ -0,0 +1,100 @@
+import csv
+import time
+
+# Counters and timings around the hot paths, cheap enough to leave on: an
+# update is a dictionary lookup and a few additions. Every metric is only
+# updated from one thread, though metrics of one Metrics may belong to
+# different threads, and the GUI reads them between updates, so there is no
+# locking. A report covers the time since the previous one. Nothing here
+# may import Qt or pyqtgraph.
+
+
+class Distribution:
+    # Count, sum and peak of observed values, like the duration of a parse or
+    # the bytes waiting at a read
+    __slots__ = ('unit', 'count', 'total', 'peak')
+
+    def __init__(self, unit):
+        self.unit = unit
+        self.count = 0
+        self.total = 0.0
+        self.peak = 0.0
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.distributions = {}
+        # Counts and sums at the last report, to report the difference
+        self.reported = {}
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value, unit=""):
+        distribution = self.distributions.get(name)
+        if (distribution is None):
+            distribution = self.distributions[name] = Distribution(unit)
+        distribution.count += 1
+        distribution.total += value
+        if (value > distribution.peak):
+            distribution.peak = value
+
+    def timing(self, name, started):
+        # Milliseconds since `started`, a time.perf_counter() value
+        self.observe(name, 1000 * (time.perf_counter() - started), "ms")
+
+    def report(self):
+        # (name, count, mean, peak, unit) of every metric since the last
+        # report. Counters have no unit, mean and peak are None for them and
+        # for distributions without observations. Peaks start over. An update
+        # racing with this can at worst lose one peak.
+        rows = []
+        for name, value in sorted(dict(self.counters).items()):
+            rows.append((name, value - self.reported.get(name, 0), None, None, None))
+            self.reported[name] = value
+        for name, distribution in sorted(dict(self.distributions).items()):
+            count, total, peak = distribution.count, distribution.total, distribution.peak
+            distribution.peak = 0.0
+            lastCount, lastTotal = self.reported.get(name, (0, 0.0))
+            self.reported[name] = (count, total)
+            if (count == lastCount):
+                rows.append((name, 0, None, None, distribution.unit))
+            else:
+                rows.append((name, count - lastCount, (total - lastTotal) / (count - lastCount), peak,
+                             distribution.unit))
+        return rows
+
+
+def describeReport(rows, seconds):
+    # One line per metric, counters as totals and rates over `seconds`
+    lines = []
+    for name, count, mean, peak, unit in rows:
+        if (unit is None):
+            lines.append("{0}: {1} ({2:.1f}/s)".format(name, count, count / seconds))
+        elif (mean is None):
+            lines.append("{0}: none".format(name))
+        else:
+            unit = " " + unit if unit else ""
+            lines.append("{0}: {1} × {2:.3g}{4} mean, {3:.3g}{4} peak".format(name, count, mean, peak, unit))
+    return lines
+
+
+class MetricsLog:
+    # Appends reports to a CSV file, one row per source and metric
+    def __init__(self, path):
+        self.file = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if (self.file.tell() == 0):
+            self.writer.writerow(["time", "source", "metric", "count", "mean", "peak", "unit"])
+
+    def write(self, source, rows, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        for name, count, mean, peak, unit in rows:
+            self.writer.writerow(["{0:.3f}".format(timestamp), source, name, count,
+                                  "" if mean is None else "{0:.6g}".format(mean),
+                                  "" if peak is None else "{0:.6g}".format(peak), unit or ""])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
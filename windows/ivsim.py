@@ -0,0 +1,317 @@
+import argparse
+import os
+import pty
+import threading
+import time
+import tty
+import numpy
+
+# Thermal voltage at room temperature
+thermalVoltage = 0.02585
+
+
+class Resistor:
+    def __init__(self, resistance=10_000):
+        self.resistance = resistance
+
+    def voltage(self, current):
+        # current in A, voltage in V
+        return current * self.resistance
+
+    def current(self, voltage):
+        return voltage / self.resistance
+
+
+class Diode:
+    # Shockley diode with series resistance
+    def __init__(self, saturationCurrent=1e-12, ideality=1.8, seriesResistance=2.0):
+        self.saturationCurrent = saturationCurrent
+        self.ideality = ideality
+        self.seriesResistance = seriesResistance
+
+    def voltage(self, current):
+        return (self.ideality * thermalVoltage * numpy.log1p(current / self.saturationCurrent)
+                + current * self.seriesResistance)
+
+    def current(self, voltage):
+        # Inverse of voltage(), by bisection since there is no closed form with
+        # series resistance
+        low, high = 0.0, voltage / max(self.seriesResistance, 1e-9)
+        for i in range(60):
+            middle = (low + high) / 2
+            if (self.voltage(middle) > voltage):
+                high = middle
+            else:
+                low = middle
+        return low
+
+
+def LED():
+    # A red LED is a diode with a much lower saturation current
+    return Diode(saturationCurrent=1e-20, ideality=2.0, seriesResistance=10.0)
+
+
+models = {"resistor": Resistor, "diode": Diode, "led": LED}
+
+# What the sketch answers to 'I'
+identity = b"IV-grapher;1.4;binary,period,oversampling,program,applied\r\n"
+
+# Bytes of the sketch's longest text line and of a binary frame, its transmit
+# buffer and its sample FIFO
+lineBytes = 30
+frameBytes = 12
+transmitBuffer = 64
+fifoSize = 16
+
+
+class SimulatedDevice:
+    # Stands in for the Arduino sketch on a pseudo-terminal. It answers the same
+    # commands (S, +/-, v/V, c/C, B/A, P, N, W/w, I), acknowledges the output
+    # commands with the applied counter and sends samples in either protocol at
+    # the configured period and oversampling, computed from a DUT model plus
+    # Gaussian noise on the ADC codes. The current source is ideal up to
+    # `compliance` volts, after which the voltage clamps. sourceGain and
+    # readGain are errors of the current source and the current reading, for
+    # trying out calibrations.
+    #
+    # Like the sketch it sends no more than a serial link at `speed` baud
+    # carries: settings that need more are refused, and samples that find the
+    # buffers full are dropped, skipping their sequence numbers.
+    def __init__(self, model=None, noise=1.0, period=32768, compliance=20.0, seed=None, sourceGain=1.0,
+                 readGain=1.0, speed=14400):
+        self.model = model if model is not None else Resistor()
+        self.noise = noise
+        self.compliance = compliance
+        self.sourceGain = sourceGain
+        self.readGain = readGain
+        self.speed = speed
+        self.dropped = 0
+        self.random = numpy.random.default_rng(seed)
+
+        self.data = 0
+        self.highVoltage = True
+        self.highCurrent = False
+        self.binaryMode = False
+        self.sequence = 0
+        self.applied = 0
+        self.period = period
+        self.oversampling = 1
+        self.program = None
+        self.stepIndex = -1
+        self.dwellCount = 0
+        # Answers to commands, sent ahead of the next samples
+        self.output = []
+
+        self.lock = threading.Lock()
+        self.running = False
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def start(self):
+        self.running = True
+        os.write(self.master, b"Setup\r\nSetup done\r\n")
+        threading.Thread(target=self.readCommands, daemon=True).start()
+        threading.Thread(target=self.sendSamples, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+    def readByte(self):
+        return os.read(self.master, 1)
+
+    def readNumber(self, terminator=b"\n"):
+        # Like the sketch: digits up to the terminator, None for anything else
+        value = 0
+        while True:
+            byte = self.readByte()
+            if (byte == terminator):
+                return value
+            if (not byte.isdigit()):
+                return None
+            value = value * 10 + int(byte)
+
+    def readCommands(self):
+        while self.running:
+            try:
+                command = self.readByte()
+            except OSError:
+                return
+            with self.lock:
+                self.handle(command)
+
+    def handle(self, command):
+        if (command == b"+"):
+            self.data += 1
+        elif (command == b"-"):
+            self.data -= 1
+        elif (command in (b"v", b"V")):
+            self.highVoltage = command == b"V"
+        elif (command in (b"c", b"C")):
+            self.highCurrent = command == b"C"
+        elif (command == b"B"):
+            self.binaryMode = True
+        elif (command == b"A"):
+            if (self.period * self.oversampling >= self.minimumInterval(False)):
+                self.binaryMode = False
+        elif (command in (b"s", b"S")):
+            value = self.readNumber()
+            if (value is not None and value < 4096):
+                self.data = value
+        elif (command in (b"p", b"P")):
+            value = self.readNumber()
+            if (value is not None and 200 <= value <= 262144
+                    and value * self.oversampling >= self.minimumInterval(self.binaryMode)):
+                self.period = value
+        elif (command in (b"n", b"N")):
+            value = self.readNumber()
+            if (value is not None and 1 <= value <= 64
+                    and self.period * value >= self.minimumInterval(self.binaryMode)):
+                self.oversampling = value
+        elif (command == b"W"):
+            fields = [self.readNumber(b";") for i in range(4)] + [self.readNumber()]
+            if (None not in fields and fields[2] > 0 and fields[3] > 0):
+                start, end, step, dwell, rangeSwitch = fields
+                self.program = {'value': start, 'end': end, 'step': step, 'dwell': dwell, 'switch': rangeSwitch}
+                self.stepIndex = 0
+                self.dwellCount = 0
+                self.applyProgram()
+        elif (command == b"w"):
+            self.program = None
+            self.stepIndex = -1
+        elif (command == b"I"):
+            self.output.append(identity)
+        if (command in (b"s", b"S", b"+", b"-", b"c", b"C")):
+            self.applied = (self.applied + 1) & 0xFF
+
+    def minimumInterval(self, binary):
+        # μs the link takes for one sample, at ten bits per byte
+        return (frameBytes if binary else lineBytes) * 10 * 1_000_000 // self.speed
+
+    def applyProgram(self):
+        if (self.program['value'] > self.program['switch']):
+            self.data = self.program['value'] // 100
+            self.highCurrent = True
+        else:
+            self.data = self.program['value']
+            self.highCurrent = False
+
+    def advanceProgram(self):
+        program = self.program
+        self.dwellCount += 1
+        if (self.dwellCount < program['dwell']):
+            return
+        self.dwellCount = 0
+        if (program['value'] > program['switch']):
+            program['value'] += program['step'] * 100
+        else:
+            program['value'] += program['step']
+        if (program['value'] > program['end']):
+            program['value'] = program['end']
+            self.applyProgram()
+            self.program = None
+            self.stepIndex = -1
+        else:
+            self.stepIndex += 1
+            self.applyProgram()
+
+    def measure(self):
+        # ADC codes for the drop voltage and measured current at the present setting
+        setCurrent = self.sourceGain * self.data * (100 if self.highCurrent else 1) / 10 / 1_000_000
+        voltage = self.model.voltage(setCurrent)
+        current = setCurrent
+        if (voltage > self.compliance):
+            voltage = self.compliance
+            current = self.model.current(voltage)
+        # The differential amplifier leaks about 1μA per volt into the reading
+        currentRead = self.readGain * current * 1_000_000 + voltage
+        dropCodes = voltage * 1000 / (10 if self.highVoltage else 1)
+        currentCodes = currentRead * 10 / (100 if self.highCurrent else 1)
+        noise = self.random.normal(0, self.noise, (2, self.oversampling)).mean(axis=1) if self.noise > 0 else (0, 0)
+        drop = int(numpy.clip(round(dropCodes + noise[0]), 0, 8191))
+        current = int(numpy.clip(round(currentCodes + noise[1]), 0, 8191))
+        return drop, current
+
+    def encode(self, drop, current):
+        if (not self.binaryMode):
+            line = "{0};{1};{2};{3:d};{4:d};{5}".format(self.data, drop, current, self.highVoltage, self.highCurrent,
+                                                        self.applied)
+            if (self.stepIndex >= 0):
+                line += ";" + str(self.stepIndex)
+            return (line + "\r\n").encode('ascii')
+        step = self.stepIndex if self.stepIndex >= 0 else 0xFFFF
+        bits = (self.data & 0x0FFF) | (drop << 12) | (current << 25) | (self.highVoltage << 38) | (self.highCurrent << 39)
+        body = (bytes([self.sequence]) + bits.to_bytes(5, 'little') + step.to_bytes(2, 'little')
+                + bytes([self.applied]))
+        self.sequence = (self.sequence + 1) & 0xFF
+        return b"\xa5\x5a" + body + bytes([sum(body) & 0xFF])
+
+    def sendSamples(self):
+        # Samples are due every period times oversampling. They are sent in
+        # catch-up bursts, so high rates do not depend on sleep() precision.
+        # budget is the bytes the link could have taken since the last burst,
+        # plus what the buffers held unused before.
+        sent = 0
+        started = time.monotonic()
+        lastPeriod = None
+        budget = 0.0
+        lastSent = started
+        while self.running:
+            with self.lock:
+                interval = self.period * self.oversampling / 1_000_000
+                now = time.monotonic()
+                if (interval != lastPeriod):
+                    started = now
+                    sent = 0
+                    lastPeriod = interval
+                sampleBytes = frameBytes if self.binaryMode else lineBytes
+                budget = (min(budget, transmitBuffer + fifoSize * sampleBytes)
+                          + (now - lastSent) * self.speed / 10)
+                lastSent = now
+                due = int((now - started) / interval) - sent
+                output = self.output
+                self.output = []
+                for i in range(due):
+                    sample = self.encode(*self.measure())
+                    if (len(sample) <= budget):
+                        output.append(sample)
+                        budget -= len(sample)
+                    else:
+                        self.dropped += 1
+                    if (self.program is not None):
+                        self.advanceProgram()
+                sent += due
+            if (len(output) > 0):
+                try:
+                    os.write(self.master, b"".join(output))
+                except OSError:
+                    return
+            time.sleep(min(interval, 0.005))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated IV-grapher on a pseudo-terminal")
+    parser.add_argument("--model", choices=sorted(models), default="resistor")
+    parser.add_argument("--noise", type=float, default=1.0, help="ADC noise, standard deviation in codes")
+    parser.add_argument("--period", type=int, default=32768, help="sample period in μs")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--source-gain", type=float, default=1.0, help="actual over set output current")
+    parser.add_argument("--read-gain", type=float, default=1.0, help="read over actual current")
+    parser.add_argument("--speed", type=int, default=14400, help="baud rate of the simulated link")
+    args = parser.parse_args()
+
+    device = SimulatedDevice(models[args.model](), noise=args.noise, period=args.period, seed=args.seed,
+                             sourceGain=args.source_gain, readGain=args.read_gain, speed=args.speed)
+    print(device.start(), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        device.stop()
+
+
+if __name__ == "__main__":
+    main()